@@ -1,13 +1,36 @@
 import boto3
+import calendar
 import logging
 import sys
-import urllib2
+import httplib
+import socket
+import select
+import ssl
 import os
+import threading
+import Queue
+import time
+import types
+import re
+import zlib
+import StringIO
+import urllib
+import urlparse
 from datetime import datetime
 import json
-import copy
+import collections
+import array
+import itertools
+import random
 from datadog import initialize, api
+try:
+    import numpy as np
+except ImportError:
+    np = None  # NumPy is optional, see NUMPY_TRANSFORM
 import citrixadcmetrics as metrics_template
+import nitroevents
+import remotewrite
+import otlp
 
 logging.basicConfig()
 
@@ -20,7 +43,148 @@ ec2_client = boto3.client('ec2')
 cw_client = boto3.client('cloudwatch')
 asg_client = boto3.client('autoscaling')
 CLOUDWATCH_NAMESPACE = 'CITRIXADC'
+DESCRIBE_INSTANCES_BATCH_SIZE = 100  # Instance IDs per describe_instances call
 DATADOG_PREFIX = 'citrixadc'
+
+'''
+    A PutMetricData request carries at most CLOUDWATCH_MAX_DATUMS
+    metrics and CLOUDWATCH_MAX_PAYLOAD bytes (AWS allows 1000 metrics
+    and 1 MB per request). Metrics are batched up to both limits, the
+    size of each metric is its query encoded size, as boto3 sends it
+'''
+CLOUDWATCH_MAX_DATUMS = int(os.environ.get('CLOUDWATCH_MAX_DATUMS', '1000'))
+CLOUDWATCH_MAX_PAYLOAD = int(os.environ.get('CLOUDWATCH_MAX_PAYLOAD', '1000000'))
+
+'''
+    CLOUDWATCH_PUT_WORKERS is the number of PutMetricData requests sent
+    in parallel. A throttled request is retried up to
+    CLOUDWATCH_PUT_RETRIES times; every throttle doubles a backoff delay
+    shared by all the requests (from CLOUDWATCH_BACKOFF_BASE up to
+    CLOUDWATCH_BACKOFF_CAP seconds) and every success halves it. Each
+    request waits a random time between 0 and that delay before going out
+'''
+CLOUDWATCH_PUT_WORKERS = int(os.environ.get('CLOUDWATCH_PUT_WORKERS', '4'))
+CLOUDWATCH_PUT_RETRIES = int(os.environ.get('CLOUDWATCH_PUT_RETRIES', '5'))
+CLOUDWATCH_BACKOFF_BASE = float(os.environ.get('CLOUDWATCH_BACKOFF_BASE', '0.1'))
+CLOUDWATCH_BACKOFF_CAP = float(os.environ.get('CLOUDWATCH_BACKOFF_CAP', '5'))
+CLOUDWATCH_BACKOFF = {'delay': 0.0}
+CLOUDWATCH_BACKOFF_LOCK = threading.Lock()
+CLOUDWATCH_THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+CLOUDWATCH_PUT_STATS = {'batches': 0, 'metrics': 0, 'bytes': 0, 'retries': 0, 'failed': 0}
+
+'''
+    CLOUDWATCH_COMPACTION folds the samples of a metric (same MetricName
+    and Dimensions) pushed together, e.g. the SCRAPE_ROUNDS of a VPX,
+    into a single metric
+    'values'     - Values/Counts, the exact values (CLOUDWATCH_MAX_VALUES
+                   distinct values per metric)
+    'statistics' - StatisticValues, only SampleCount/Sum/Minimum/Maximum
+    'none'       - a metric per sample
+'''
+CLOUDWATCH_COMPACTION = os.environ.get('CLOUDWATCH_COMPACTION', 'values')
+CLOUDWATCH_MAX_VALUES = 150
+
+'''
+    CLOUDWATCH_SINK selects how the metrics get to CloudWatch
+    'api' - PutMetricData requests
+    'emf' - Embedded Metric Format documents written to the Lambda's log,
+            no API calls; at most EMF_MAX_METRICS metrics per document
+'''
+CLOUDWATCH_SINK = os.environ.get('CLOUDWATCH_SINK', 'api')
+EMF_MAX_METRICS = 100
+
+'''
+    DATADOG_SINK selects how the metrics get to Datadog
+    'api'       - api.Metric.send of the datadog library, all in one request
+    'v2'        - the v2 series intake of DATADOG_SITE, gzip compressed
+                  payloads of at most DATADOG_MAX_PAYLOAD bytes
+                  (DATADOG_MAX_RAW uncompressed), DATADOG_SEND_WORKERS of
+                  them in flight. Every counter goes out as a gauge, like
+                  with dogstatsd
+    'dogstatsd' - UDP datagrams of at most DOGSTATSD_MAX_DATAGRAM bytes to
+                  the Datadog agent/extension at DOGSTATSD_HOST:DOGSTATSD_PORT,
+                  which holds the API key. Datagrams the socket can't take
+                  right away are dropped. Every counter goes out as a gauge
+                  (|g): Nitro counters are cumulative totals or point-in-time
+                  readings, never the per-interval deltas the agent sums
+                  DogStatsD counts (|c) over
+'''
+DATADOG_SINK = os.environ.get('DATADOG_SINK', 'api')
+DATADOG_SITE = os.environ.get('DATADOG_SITE', 'datadoghq.com')
+DATADOG_MAX_PAYLOAD = int(os.environ.get('DATADOG_MAX_PAYLOAD', '512000'))
+DATADOG_MAX_RAW = int(os.environ.get('DATADOG_MAX_RAW', '5242880'))
+DATADOG_SEND_WORKERS = int(os.environ.get('DATADOG_SEND_WORKERS', '4'))
+DATADOG_TIMEOUT = float(os.environ.get('DATADOG_TIMEOUT', '10'))
+DATADOG_V2_GAUGE = 3  # v2 series type; 0 is unspecified, 1 count, 2 rate
+DATADOG_GZIP_MARGIN = 64  # Bytes kept for the closing ]} and the gzip trailer
+DOGSTATSD_HOST = os.environ.get('DOGSTATSD_HOST', '127.0.0.1')
+DOGSTATSD_PORT = int(os.environ.get('DOGSTATSD_PORT', '8125'))
+DOGSTATSD_MAX_DATAGRAM = int(os.environ.get('DOGSTATSD_MAX_DATAGRAM', '1432'))  # Fits a 1500 bytes MTU
+DOGSTATSD_SOCKET = None
+
+'''
+    PROMETHEUS_REMOTE_WRITE_URL, when set, adds a Prometheus remote write
+    sink, e.g. http://mimir:8080/api/v1/push. The series are named after
+    the template Description and pushed in WriteRequests of at most
+    PROMETHEUS_MAX_SERIES series and PROMETHEUS_MAX_BYTES bytes before
+    compression, one request after the other to keep each series in
+    order. PROMETHEUS_TENANT sets the X-Scope-OrgID of multi-tenant
+    receivers (Mimir, Cortex), PROMETHEUS_BEARER_TOKEN an Authorization
+'''
+PROMETHEUS_REMOTE_WRITE_URL = os.environ.get('PROMETHEUS_REMOTE_WRITE_URL', '')
+PROMETHEUS_MAX_SERIES = int(os.environ.get('PROMETHEUS_MAX_SERIES', '2000'))
+PROMETHEUS_MAX_BYTES = int(os.environ.get('PROMETHEUS_MAX_BYTES', '1048576'))
+PROMETHEUS_TENANT = os.environ.get('PROMETHEUS_TENANT', '')
+PROMETHEUS_BEARER_TOKEN = os.environ.get('PROMETHEUS_BEARER_TOKEN', '')
+PROMETHEUS_TIMEOUT = float(os.environ.get('PROMETHEUS_TIMEOUT', '10'))
+
+'''
+    OTEL_EXPORTER_OTLP_METRICS_ENDPOINT (the full URL) or
+    OTEL_EXPORTER_OTLP_ENDPOINT (the collector, /v1/metrics appended),
+    when set, adds an OTLP/HTTP metrics sink. The metrics of all the
+    VPX(s) go out in a single protobuf export request per invocation,
+    split only past OTLP_MAX_BYTES, gzip compressed unless
+    OTEL_EXPORTER_OTLP_COMPRESSION=none. OTEL_EXPORTER_OTLP_HEADERS adds
+    request headers (key=value,key=value), OTEL_EXPORTER_OTLP_TIMEOUT is
+    in milliseconds
+'''
+OTLP_ENDPOINT = os.environ.get('OTEL_EXPORTER_OTLP_METRICS_ENDPOINT', '')
+if not OTLP_ENDPOINT and os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT'):
+    OTLP_ENDPOINT = os.environ['OTEL_EXPORTER_OTLP_ENDPOINT'].rstrip('/') + '/v1/metrics'
+
+def get_otlp_headers(headers):
+    '''
+        Method to parse OTEL_EXPORTER_OTLP_HEADERS, key=value pairs
+        separated by commas with URL encoded keys and values
+    '''
+    otlp_headers = {}
+    for header in headers.split(','):
+        if '=' in header:
+            name, value = header.split('=', 1)
+            otlp_headers[urllib.unquote(name.strip())] = urllib.unquote(value.strip())
+    return otlp_headers
+
+OTLP_HEADERS = get_otlp_headers(os.environ.get('OTEL_EXPORTER_OTLP_HEADERS', ''))
+OTLP_COMPRESSION = os.environ.get('OTEL_EXPORTER_OTLP_COMPRESSION', 'gzip')
+OTLP_TIMEOUT = float(os.environ.get('OTEL_EXPORTER_OTLP_TIMEOUT', '10000')) / 1000
+OTLP_MAX_BYTES = int(os.environ.get('OTLP_MAX_BYTES', '4194304'))
+OTLP_UNITS = {'Count': '1', 'Count/Second': '1/s', 'Percent': '%', 'Megabytes': 'MBy',
+              'Bytes': 'By', 'Seconds': 's', 'Milliseconds': 'ms'}  # CloudWatch Unit -> UCUM
+OTLP_PENDING = []  # ResourceMetrics pushed during the invocation, exported at its end
+
+'''
+    The metrics CloudWatch or Datadog fail to take are spilled to
+    SPILL_DIR and pushed again, oldest first, at the start of the next
+    warm invocation, in batches of up to SPILL_REPLAY_BYTES of spilled
+    metrics. Spilled metrics older than SPILL_MAX_AGE seconds are
+    dropped, as are the oldest ones once the spill exceeds
+    SPILL_MAX_BYTES. SPILL_DIR = '' (empty) disables spilling
+'''
+SPILL_DIR = os.environ.get('SPILL_DIR', '/tmp/citrixadc-spill')
+SPILL_MAX_BYTES = int(os.environ.get('SPILL_MAX_BYTES', str(64 * 1024 * 1024)))
+SPILL_MAX_AGE = float(os.environ.get('SPILL_MAX_AGE', '3600'))  # Datadog drops points older than an hour
+SPILL_REPLAY_BYTES = int(os.environ.get('SPILL_REPLAY_BYTES', str(2 * 1024 * 1024)))
+SPILL_SEQUENCE = itertools.count()
 '''
     Use the INCLUDE_FEATURES list to specify what features stats
     to pull and push to CloudWatch
@@ -30,6 +194,102 @@ DATADOG_PREFIX = 'citrixadc'
 INCLUDE_FEATURES = ['system', 'protocolhttp', 'lbvserver', 'csvserver']
 #INCLUDE_FEATURES = []
 
+'''
+    MAX_SCRAPE_WORKERS is the number of VPX(s) scraped in parallel
+    MAX_SCRAPE_WORKERS = 1 would scrape the VPX(s) one after another
+    MAX_FEATURE_WORKERS is the number of features fetched in parallel
+    from a single VPX, capped to go easy on the NSIP management CPU
+    NITRO_TIMEOUT (in seconds) bounds every Nitro request so that a
+    slow VPX can't hold a worker for the whole Lambda timeout
+'''
+MAX_SCRAPE_WORKERS = int(os.environ.get('MAX_SCRAPE_WORKERS', '10'))
+MAX_FEATURE_WORKERS = int(os.environ.get('MAX_FEATURE_WORKERS', '4'))
+NITRO_TIMEOUT = float(os.environ.get('NITRO_TIMEOUT', '10'))
+
+'''
+    COLLECTION_ENGINE selects how the Nitro Stats are collected
+    'threads' - a pool of MAX_SCRAPE_WORKERS threads, one VPX per thread
+    'events'  - a single event loop driving every VPX x feature request,
+                with at most MAX_INFLIGHT_REQUESTS in flight overall,
+                MAX_FEATURE_WORKERS per VPX and all of them finished
+                within SCRAPE_DEADLINE seconds
+'''
+COLLECTION_ENGINE = os.environ.get('COLLECTION_ENGINE', 'threads')
+MAX_INFLIGHT_REQUESTS = int(os.environ.get('MAX_INFLIGHT_REQUESTS', '64'))
+SCRAPE_DEADLINE = float(os.environ.get('SCRAPE_DEADLINE', '60'))
+
+'''
+    SCRAPE_ROUNDS > 1 scrapes the VPX(s) that many times per invocation,
+    SCRAPE_INTERVAL seconds apart, for sub-minute resolution. The rounds
+    of a VPX are pushed together after the last one, so keep
+    SCRAPE_ROUNDS x SCRAPE_INTERVAL well within the Lambda timeout
+'''
+SCRAPE_ROUNDS = int(os.environ.get('SCRAPE_ROUNDS', '1'))
+SCRAPE_INTERVAL = float(os.environ.get('SCRAPE_INTERVAL', '10'))
+
+'''
+    Only the counters used by the metrics template are requested from
+    Nitro (?attrs=...), which keeps large lbvserver/csvserver/service
+    responses small. Set NITRO_ATTRS_PROJECTION=false to fetch all the
+    attributes. NITRO_ENTITY_FEATURES are the features that return a
+    list of named entities
+'''
+NITRO_ATTRS_PROJECTION = os.environ.get('NITRO_ATTRS_PROJECTION', 'true').lower() == 'true'
+NITRO_ENTITY_FEATURES = ['lbvserver', 'csvserver', 'service']
+
+'''
+    NITRO_PAGE_SIZE > 0 pulls the NITRO_ENTITY_FEATURES in pages of that
+    many entities, streaming each page through to the sinks so that the
+    memory used doesn't grow with the number of vservers/services
+    NITRO_PAGE_SIZE = 0 pulls all the entities in one request
+'''
+NITRO_PAGE_SIZE = int(os.environ.get('NITRO_PAGE_SIZE', '0'))
+
+'''
+    NITRO_STREAM_DECODE decodes the NITRO_ENTITY_FEATURES responses one
+    entity at a time as they are received, NITRO_READ_SIZE bytes at a
+    time, instead of loading the whole JSON document
+'''
+NITRO_STREAM_DECODE = os.environ.get('NITRO_STREAM_DECODE', 'true').lower() == 'true'
+NITRO_READ_SIZE = int(os.environ.get('NITRO_READ_SIZE', '65536'))
+
+'''
+    NITRO_COMPRESSION asks the VPX for gzip/deflate compressed responses
+    (Nitro stat JSON compresses about 10x), which are decompressed while
+    they are read
+'''
+NITRO_COMPRESSION = os.environ.get('NITRO_COMPRESSION', 'true').lower() == 'true'
+
+'''
+    NUMPY_TRANSFORM parses the entity lists with NumPy, when NumPy is in
+    the deployment package, NUMPY_BLOCK_SIZE entities at a time. Without
+    NumPy the entities are parsed one by one in plain python
+'''
+NUMPY_TRANSFORM = os.environ.get('NUMPY_TRANSFORM', 'true').lower() == 'true'
+NUMPY_BLOCK_SIZE = int(os.environ.get('NUMPY_BLOCK_SIZE', '1024'))
+NUMPY_MAX_DIGITS = 18  # Longest value sure to fit an int64 (2^63 - 1 has 19 digits)
+
+'''
+    Idle keep-alive connections to the NSIP(s) {(scheme, NSIP): [(connection, last used)]}
+    Kept at module scope so that they are reused across the features of
+    a scrape and across warm Lambda invocations. Connections idle for
+    more than KEEPALIVE_IDLE_TIMEOUT seconds are not reused
+'''
+NITRO_CONNECTION_POOL = {}
+NITRO_CONNECTION_POOL_LOCK = threading.Lock()
+KEEPALIVE_IDLE_TIMEOUT = float(os.environ.get('KEEPALIVE_IDLE_TIMEOUT', '50'))
+
+'''
+    The discovered VPX(s) of each ASG are cached at module scope so that
+    warm invocations can skip discovery. For DISCOVERY_CACHE_TTL seconds
+    no EC2/ASG API calls are made at all; after that the ASG is described
+    again and its instances only re-described if the ASG has changed
+    DISCOVERY_CACHE_TTL = 0 checks the ASG on every invocation
+'''
+DISCOVERY_CACHE = {}
+DISCOVERY_CACHE_STATS = {'hits': 0, 'misses': 0}
+DISCOVERY_CACHE_TTL = float(os.environ.get('DISCOVERY_CACHE_TTL', '300'))
+
 CLOUDWATCH_TEMPLATE = {
     "MetricName": "",
     "Value": "",
@@ -63,150 +323,662 @@ DATADOG_TEMPLATE = {
     ]
 }
 
-def parse_stats_cloudwatch(vpx_instance_info, metrics, stats):
-    '''
-        Method to update the metrics json template with the 
-        Nitro Stats got from the VPX
-        CLOUDWATCH_TEMPLATE = {
-                "MetricName": "",
-                "Value": "",
-                "Timestamp": "",
-                "Unit": "Count",
-                "Dimensions": [
-                    {
-                        "Name": "Description",
-                        "Value": ""
-                    },
-                    {
-                        "Name": "CitrixADC-AutoScale-Group",
-                        "Value": ""
-                    },
-                    {
-                        "Name": "CitrixADC-InstanceID",
-                        "Value": ""
-                    }
-                ]
-        }
+'''
+    The metrics template compiled once into a plan of what to fill for
+    each counter of each feature, so that the transform doesn't have to
+    copy and fill the CLOUDWATCH_TEMPLATE/DATADOG_TEMPLATE every time
+    {feature: [CounterPlan, ...]}
+'''
+CounterPlan = collections.namedtuple('CounterPlan', [
+    'name',                   # Nitro counter name, also the CloudWatch MetricName
+    'description',
+    'unit',                   # CloudWatch Unit
+    'type',                   # Template Type, lower cased as Datadog wants it
+    'cloudwatch_dimension',   # {'Name': 'Description', 'Value': description}
+    'datadog_metric'          # DATADOG_PREFIX.name
+])
+
+def compile_metric_plan(metrics):
+    '''
+        Method to compile the metrics template into a metric plan
+    '''
+    plan = {}
+    for feature, counters in metrics.items():
+        plan[feature] = [CounterPlan(
+            name=counter['MetricName'],
+            description=counter['Description'],
+            unit=counter['Unit'],
+            type=counter['Type'].lower(),
+            cloudwatch_dimension={'Name': 'Description', 'Value': counter['Description']},
+            datadog_metric=DATADOG_PREFIX + '.' + counter['MetricName']) for counter in counters]
+    return plan
+
+METRIC_PLAN = compile_metric_plan(metrics_template.metrics)
+
+'''
+    A sample is one datapoint scraped from a VPX, independent of the sink
+    it is pushed to. Samples are produced once per scrape by parse_stats
+    into a SampleStore and encoded for each of the enabled sinks (see
+    SINKS) only when they are pushed
+    Iterating a SampleStore gives (counter, value, entity, vpx, timestamp)
+    counter   - CounterPlan: metric name, description, unit and type
+    value     - int value of the counter
+    entity    - (feature, entity name) for the entity list features, else None
+    vpx       - vpx_instance_info of the instance the samples came from
+    timestamp - datetime of the scrape
+'''
+class SampleStore(object):
+    '''
+        Column store of the samples of one VPX scrape
+        A sample costs 2 bytes of counter index, 8 bytes of value and 8
+        bytes of entity index, plus its share of the interned counter
+        and entity tables (one (feature, name) tuple per entity)
+        Values are signed 64 bit ints; a Nitro counter (unsigned 64 bit)
+        past that range is skipped, sample by sample
+    '''
+    __slots__ = ['vpx', 'timestamp', 'counters', 'entities', 'entity_index',
+                 'counter_ids', 'values', 'entity_ids']
+
+    def __init__(self, vpx, timestamp):
+        self.vpx = vpx
+        self.timestamp = timestamp
+        self.counters = []        # Interned CounterPlan(s)
+        self.entities = []        # Interned (feature, entity name)
+        self.entity_index = {}
+        self.counter_ids = array.array('H')
+        self.values = array.array('l')
+        self.entity_ids = array.array('l')  # -1 for samples without entity
+
+    def add_counters(self, counters):
+        '''
+            Method to intern a feature's counters, returns the index of
+            the first one; the rest follow in order
+        '''
+        first = len(self.counters)
+        self.counters.extend(counters)
+        return first
+
+    def add_entity(self, feature, name):
+        '''
+            Method to intern an entity, returns its index
+        '''
+        entity = (feature, name)
+        index = self.entity_index.get(entity)
+        if index is None:
+            index = self.entity_index[entity] = len(self.entities)
+            self.entities.append(entity)
+        return index
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        counters, entities = self.counters, self.entities
+        vpx, timestamp = self.vpx, self.timestamp
+        for counter_id, value, entity_id in itertools.izip(self.counter_ids, self.values, self.entity_ids):
+            yield (counters[counter_id], value, entities[entity_id] if entity_id >= 0 else None,
+                   vpx, timestamp)
+
+def parse_stats(vpx_instance_info, metrics, stats):
+    '''
+        Method to turn the Nitro Stats got from the VPX into a SampleStore,
+        as laid out by the metric plan
+        Entity lists are iterated once, so streamed lists are consumed as
+        they are decoded
     '''
-    filled_metrics = []
+    samples = SampleStore(vpx_instance_info, datetime.now())
     for feature in stats.keys():
-        for counter in metrics[feature]:
-            filled_counter = copy.deepcopy(CLOUDWATCH_TEMPLATE)
-            if type(stats[feature][feature]) == list:
-                filled_counter['MetricName'] = counter['MetricName']
-                filled_counter['Dimensions'][0]['Value'] = counter['Description']
-                filled_counter['Unit'] = counter['Unit']
-                filled_counter = get_each_stats_cloudwatch(filled_counter, stats[feature][feature], feature, vpx_instance_info)
-                filled_metrics.extend(filled_counter) # Extend the list - Don't append
-                continue
-            # Counter is from the input metrics template
-            # filled_counter is the CLOUDWATCH_TEMPLATE which is being filled
-            if counter['MetricName'] in stats[feature][feature]:
-                filled_counter['MetricName'] = counter['MetricName']
-                filled_counter['Dimensions'][0]['Value'] = counter['Description']
-                filled_counter['Unit'] = counter['Unit']
-                filled_counter['Value'] = int(stats[feature][feature].get(filled_counter['MetricName'], 0))
-                filled_counter['Timestamp'] = datetime.now()
-                filled_counter['Dimensions'][1]['Value'] = vpx_instance_info['asg-name']  # AutoScale Group
-                filled_counter['Dimensions'][2]['Value'] = vpx_instance_info['instance-id']  # Instance ID
-                filled_metrics.append(filled_counter)
-    return filled_metrics
-
-def get_each_stats_cloudwatch(filled_counter, stats, feature, vpx_instance_info):
-    '''
-        Method to iterate through the list of entities and create metrics
-    '''
-    filled_metrics = []
-    for each_stat in stats:
-        if filled_counter['MetricName'] in each_stat:
-            filled_counter['Value'] = int(each_stat.get(filled_counter['MetricName'], 0))
-            filled_counter['Timestamp'] = datetime.now()
-            filled_counter['Dimensions'][1]['Value'] = vpx_instance_info['asg-name']  # AutoScale Group
-            filled_counter['Dimensions'][2]['Value'] = vpx_instance_info['instance-id']  # Instance ID
-            if len(filled_counter['Dimensions']) == 4:  # assume the feature dimension is already set
-                filled_counter['Dimensions'][3]['Value'] = each_stat['name']
-            elif len(filled_counter['Dimensions']) == 3:  # newly add the feature dimension
-                filled_counter['Dimensions'].append({'Name': feature, 'Value': each_stat['name']})  # Add the name of the feature to a dimension
-            filled_metrics.append(filled_counter)
-    return filled_metrics
-
-
-def parse_stats_datadog(vpx_instance_info, metrics, stats):
-    '''
-        Method to update the metrics json template with the 
-        Nitro Stats got from the VPX
-        DATADOG_TEMPLATE = {
-            "metric": "",
-            "description": "",
-            "type": "",
-            "points": "",
-            "host": "",
-            "tags": [
-                "CitrixADC-AutoScale-Group:autoscalegroup",
-                "Source:AWS"
-            ]
+        feature_stats = stats[feature][feature]
+        counters = metrics[feature]
+        first = samples.add_counters(counters)
+        if type(feature_stats) == dict:
+            for i, counter in enumerate(counters):
+                if counter.name in feature_stats:
+                    try:
+                        samples.values.append(int(feature_stats[counter.name]))
+                    except OverflowError:
+                        continue  # Doesn't fit the store, see SampleStore
+                    samples.counter_ids.append(first + i)
+                    samples.entity_ids.append(-1)
+            continue
+        if np is not None and NUMPY_TRANSFORM:
+            parse_entities_numpy(samples, feature, counters, first, feature_stats)
+            continue
+        parse_entities(samples, feature, counters, first, feature_stats)
+    return samples
+
+def parse_entities(samples, feature, counters, first, entities):
+    '''
+        Method to add the samples of a list of entities to the SampleStore
+        first is the index of the feature's first counter in the store
+    '''
+    add_counter_id = samples.counter_ids.append
+    add_value = samples.values.append
+    add_entity_id = samples.entity_ids.append
+    for each_stat in entities:
+        entity_id = samples.add_entity(feature, each_stat['name'])
+        for i, counter in enumerate(counters):
+            if counter.name in each_stat:
+                try:
+                    add_value(int(each_stat[counter.name]))
+                except OverflowError:
+                    continue  # Doesn't fit the store, see SampleStore
+                add_counter_id(first + i)
+                add_entity_id(entity_id)
+
+def parse_entities_numpy(samples, feature, counters, first, entities):
+    '''
+        Method to add the samples of a list of entities to the SampleStore
+        with NumPy, NUMPY_BLOCK_SIZE entities at a time: the counters of a
+        block are gathered into an (entities x counters) matrix in one
+        pass, the missing ones masked out and the rest converted to int64
+        and appended to the store's columns as whole arrays
+        A block NumPy can't convert goes through parse_entities instead,
+        as does one with values of 19 digits or more, that may not fit
+        an int64
+    '''
+    names = [counter.name for counter in counters]
+    entities = iter(entities)
+    while True:
+        block = list(itertools.islice(entities, NUMPY_BLOCK_SIZE))
+        if not block:
+            return
+        matrix = np.array([[each_stat.get(name, '') for name in names] for each_stat in block], dtype=str)
+        present = matrix != ''
+        try:
+            if matrix.dtype.itemsize > NUMPY_MAX_DIGITS:
+                raise OverflowError
+            values = matrix[present].astype(np.int64)
+        except (ValueError, OverflowError):
+            parse_entities(samples, feature, counters, first, block)
+            continue
+        entity_rows, counter_columns = np.nonzero(present)  # Row major, same order as parse_entities
+        entity_ids = np.array([samples.add_entity(feature, each_stat['name']) for each_stat in block],
+                              dtype=np.int64)
+        samples.counter_ids.fromstring((counter_columns + first).astype(np.uint16).tostring())
+        samples.values.fromstring(values.tostring())
+        samples.entity_ids.fromstring(entity_ids[entity_rows].tostring())
+
+def encode_cloudwatch(samples):
+    '''
+        Method to encode samples as CloudWatch MetricData
+        (see CLOUDWATCH_TEMPLATE), one metric at a time
+        The dimension dicts are shared, never modified, by the metrics:
+        Description (from the plan), AutoScale Group and Instance ID (per
+        VPX) and the feature dimension (per entity)
+    '''
+    vpx = entity = None
+    for counter, value, sample_entity, sample_vpx, timestamp in samples:
+        if sample_vpx is not vpx:
+            vpx = sample_vpx
+            asg_dimension = {'Name': 'CitrixADC-AutoScale-Group', 'Value': vpx['asg-name']}
+            instance_dimension = {'Name': 'CitrixADC-InstanceID', 'Value': vpx['instance-id']}
+        if sample_entity is None:
+            dimensions = [counter.cloudwatch_dimension, asg_dimension, instance_dimension]
+        else:
+            if sample_entity is not entity:
+                entity = sample_entity
+                entity_dimension = {'Name': entity[0], 'Value': entity[1]}
+            dimensions = [counter.cloudwatch_dimension, asg_dimension, instance_dimension, entity_dimension]
+        yield {
+            'MetricName': counter.name,
+            'Value': value,
+            'Timestamp': timestamp,
+            'Unit': counter.unit,
+            'Dimensions': dimensions
         }
+
+def encode_cloudwatch_compact(samples):
     '''
-    filled_metrics = []
-    for feature in stats.keys():
-        for counter in metrics[feature]:
-            filled_counter = copy.deepcopy(DATADOG_TEMPLATE)
-            if type(stats[feature][feature]) == list:
-                filled_counter['metric'] = counter['MetricName']
-                filled_counter['description'] = counter['Description']
-                filled_counter['type'] = counter['Type'].lower()
-                filled_counter = get_each_stats_datadog(filled_counter, stats[feature][feature], feature, vpx_instance_info)
-                filled_metrics.extend(filled_counter) # Extend the list - Don't append
+        Method to encode samples as CloudWatch MetricData, folding the
+        samples of the same metric into one (see CLOUDWATCH_COMPACTION)
+        A single SampleStore, one scrape, has nothing to fold and is
+        encoded as is
+    '''
+    if isinstance(samples, SampleStore):
+        return encode_cloudwatch(samples)
+    return fold_cloudwatch_metrics(samples)
+
+def fold_cloudwatch_metrics(samples):
+    '''
+        Method to encode samples as CloudWatch MetricData, one metric per
+        MetricName and Dimensions. A metric sampled once keeps its plain
+        Value, the folded ones take the Timestamp of their last sample
+        The samples are all read before the first metric is yielded
+    '''
+    series = []   # [last sample, values] in the order first seen
+    index = {}    # (counter, instance-id, entity) -> series entry
+    for sample in samples:
+        counter, value, entity, vpx, timestamp = sample
+        key = (id(counter), vpx['instance-id'], entity)
+        folded = index.get(key)
+        if folded is None:
+            folded = index[key] = [sample, [value]]
+            series.append(folded)
+        else:
+            folded[0] = sample
+            folded[1].append(value)
+    datums = encode_cloudwatch(folded[0] for folded in series)
+    for datum, (_, values) in itertools.izip(datums, series):
+        if len(values) == 1:
+            yield datum
+            continue
+        del datum['Value']
+        if CLOUDWATCH_COMPACTION == 'statistics':
+            datum['StatisticValues'] = {
+                'SampleCount': len(values),
+                'Sum': sum(values),
+                'Minimum': min(values),
+                'Maximum': max(values)
+            }
+            yield datum
+            continue
+        counts = collections.Counter(values).items()
+        for i in range(0, len(counts), CLOUDWATCH_MAX_VALUES):
+            chunk = counts[i:i + CLOUDWATCH_MAX_VALUES]
+            yield dict(datum, Values=[value for value, _ in chunk], Counts=[count for _, count in chunk])
+
+def encode_datadog(samples):
+    '''
+        Method to encode samples as Datadog series (see DATADOG_TEMPLATE),
+        one series at a time
+        Entity samples get an extra feature:name tag
+        Points are stamped with the scrape timestamp, not the push time
+    '''
+    vpx = entity = scraped = None
+    for counter, value, sample_entity, sample_vpx, timestamp in samples:
+        if sample_vpx is not vpx:
+            vpx = sample_vpx
+            asg_tag = "CitrixADC-AutoScale-Group:" + vpx['asg-name']
+            host = vpx['instance-id']  # Instance ID
+        if timestamp is not scraped:
+            scraped = timestamp
+            epoch = get_epoch(timestamp)
+        if sample_entity is None:
+            tags = [asg_tag, "Source:AWS"]
+        else:
+            if sample_entity is not entity:
+                entity = sample_entity
+                entity_tag = entity[0] + ":" + entity[1]
+            tags = [asg_tag, "Source:AWS", entity_tag]
+        yield {
+            'metric': counter.datadog_metric,
+            'description': counter.description,
+            'type': counter.type,
+            'points': [(epoch, value)],
+            'host': host,
+            'tags': tags
+        }
+
+def encode_datadog_v2(samples):
+    '''
+        Method to encode samples as Datadog v2 series, one JSON string
+        at a time, from the series of encode_datadog
+        All of them are gauges, see DATADOG_SINK
+    '''
+    for series in encode_datadog(samples):
+        timestamp, value = series['points'][0]
+        yield json.dumps({
+            'metric': series['metric'],
+            'type': DATADOG_V2_GAUGE,
+            'points': [{'timestamp': int(timestamp), 'value': value}],
+            'resources': [{'name': series['host'], 'type': 'host'}],
+            'tags': series['tags']
+        })
+
+def encode_dogstatsd(samples):
+    '''
+        Method to encode samples as DogStatsD lines, one at a time, with
+        the tags of encode_datadog. The host goes in a host: tag
+        All of them are gauges, see DATADOG_SINK
+    '''
+    vpx = entity = None
+    for counter, value, sample_entity, sample_vpx, timestamp in samples:
+        if sample_vpx is not vpx:
+            vpx = sample_vpx
+            vpx_tags = ("CitrixADC-AutoScale-Group:" + vpx['asg-name'] + ",Source:AWS,host:" +
+                        vpx['instance-id'])
+            if isinstance(vpx_tags, unicode):
+                vpx_tags = vpx_tags.encode('utf-8')
+            vpx_tags = vpx_tags.replace('|', '_')
+            entity = None
+        if sample_entity is None:
+            tags = vpx_tags
+        else:
+            if sample_entity is not entity:
+                entity = sample_entity
+                entity_tag = entity[0] + ":" + entity[1]
+                if isinstance(entity_tag, unicode):
+                    entity_tag = entity_tag.encode('utf-8')
+                entity_tags = vpx_tags + ',' + entity_tag.replace('|', '_')
+            tags = entity_tags
+        yield counter.datadog_metric + ':' + str(value) + '|g|#' + tags
+
+def encode_prometheus(samples):
+    '''
+        Method to encode samples as remote write TimeSeries, one protobuf
+        encoded series at a time (see remotewrite)
+        Labels: __name__ (the template Description), autoscale_group,
+        instance (the Instance ID) and feature="entity name" for entities
+    '''
+    names = {}  # id(counter) -> __name__ label
+    vpx = entity = scraped = None
+    for counter, value, sample_entity, sample_vpx, timestamp in samples:
+        if sample_vpx is not vpx:
+            vpx = sample_vpx
+            entity = None
+            vpx_labels = [('autoscale_group', remotewrite.encode_label('autoscale_group', vpx['asg-name'])),
+                          ('instance', remotewrite.encode_label('instance', vpx['instance-id']))]
+            labels = ''.join(label for _, label in vpx_labels)
+        if timestamp is not scraped:
+            scraped = timestamp
+            millis = int(get_epoch(timestamp) * 1000)
+        if sample_entity is None:
+            series_labels = labels
+        elif sample_entity is not entity:
+            entity = sample_entity
+            entity_labels = vpx_labels + [(entity[0], remotewrite.encode_label(entity[0], entity[1]))]
+            series_labels = ''.join(label for _, label in sorted(entity_labels))
+        name = names.get(id(counter))
+        if name is None:
+            name = names[id(counter)] = remotewrite.encode_label('__name__', counter.description)
+        yield remotewrite.encode_timeseries(name + series_labels, value, millis)
+
+def encode_otlp(samples):
+    '''
+        Method to encode samples as OTLP ResourceMetrics, one protobuf
+        encoded resource per VPX (see otlp)
+        A VPX's samples are grouped into one Metric per counter, named
+        after the template Description, with a data point per entity
+        (feature="entity name" attribute) and scrape
+        Sum points start at the VPX's EC2 launch time, as the Nitro totals
+        count from its boot; left unset when the launch time isn't known
+    '''
+    resources = []  # (vpx, [counter], {id(counter): [data point]}) in the order first seen
+    by_instance = {}
+    sums = {}  # id(counter) -> whether its points are of a sum
+    vpx = entity = scraped = None
+    for counter, value, sample_entity, sample_vpx, timestamp in samples:
+        if sample_vpx is not vpx:
+            vpx = sample_vpx
+            resource = by_instance.get(vpx['instance-id'])
+            if resource is None:
+                resource = by_instance[vpx['instance-id']] = (vpx, [], {})
+                resources.append(resource)
+            counters, points = resource[1], resource[2]
+            launch_unix_nano = int(vpx['launch-time'] * 1e9) if vpx.get('launch-time') else 0
+        if timestamp is not scraped:
+            scraped = timestamp
+            time_unix_nano = int(get_epoch(timestamp) * 1e9)
+        if sample_entity is None:
+            attributes = ''
+        elif sample_entity is not entity:
+            entity = sample_entity
+            attributes = otlp.encode_attribute(entity[0], entity[1], 7)
+        counter_points = points.get(id(counter))
+        if counter_points is None:
+            counter_points = points[id(counter)] = []
+            counters.append(counter)
+            if id(counter) not in sums:
+                sums[id(counter)] = get_otlp_kind(counter)[0] == otlp.SUM
+        counter_points.append(otlp.encode_number_point(attributes, time_unix_nano, value,
+                                                       launch_unix_nano if sums[id(counter)] else 0))
+    for vpx, counters, points in resources:
+        metrics = []
+        for counter in counters:
+            kind, monotonic = get_otlp_kind(counter)
+            metrics.append(otlp.encode_metric(counter.description, counter.name, OTLP_UNITS.get(counter.unit, ''),
+                                              kind, monotonic, points[id(counter)]))
+        attributes = ''.join(otlp.encode_attribute(name, value, 1) for name, value in [
+            ('service.name', 'citrixadc'),
+            ('host.id', vpx['instance-id']),
+            ('cloud.provider', 'aws'),
+            ('citrixadc.autoscale_group', vpx['asg-name'])
+        ])
+        yield otlp.encode_resource_metrics(attributes, 'citrixadc-lambda', '', metrics)
+
+def get_otlp_kind(counter):
+    '''
+        Method to map a counter's template Type and Unit to an OTLP
+        (kind, monotonic): counts (Type Count) of things (Unit Count)
+        named as totals (_total) are monotonic cumulative sums; other
+        counts are point-in-time readings (connections open, entries in
+        use) and, like rates, percentages and sizes, gauges
+    '''
+    if counter.type == 'count' and counter.unit == 'Count' and counter.description.endswith('_total'):
+        return otlp.SUM, True
+    return otlp.GAUGE, False
+
+def encode_emf(samples):
+    '''
+        Method to encode samples as CloudWatch Embedded Metric Format
+        documents, one JSON string at a time
+        Consecutive samples of a scrape without entity share a document,
+        as do those of an entity. A document has a single value per
+        dimension, so the EMF metrics have no Description dimension
+    '''
+    document = document_vpx = document_timestamp = document_entity = None
+    metrics = []
+    for counter, value, entity, vpx, timestamp in samples:
+        if document is None or vpx is not document_vpx or timestamp is not document_timestamp or \
+                entity != document_entity or len(metrics) >= EMF_MAX_METRICS or counter.name in document:
+            if document is not None:
+                yield json.dumps(document)
+            document_vpx, document_timestamp, document_entity = vpx, timestamp, entity
+            dimensions = ['CitrixADC-AutoScale-Group', 'CitrixADC-InstanceID']
+            document = {
+                'CitrixADC-AutoScale-Group': vpx['asg-name'],
+                'CitrixADC-InstanceID': vpx['instance-id']
+            }
+            if entity is not None:
+                dimensions.append(entity[0])
+                document[entity[0]] = entity[1]
+            metrics = []
+            document['_aws'] = {
+                'Timestamp': int(get_epoch(timestamp) * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': CLOUDWATCH_NAMESPACE,
+                    'Dimensions': [dimensions],
+                    'Metrics': metrics
+                }]
+            }
+        metrics.append({'Name': counter.name, 'Unit': counter.unit})
+        document[counter.name] = value
+    if document is not None:
+        yield json.dumps(document)
+
+def get_epoch(timestamp):
+    '''
+        Method to convert a (local time) datetime into seconds since epoch
+    '''
+    return time.mktime(timestamp.timetuple()) + timestamp.microsecond / 1e6
+
+def scrape_citrixadc_metrics(vpx, metrics, features):
+    '''
+        Method to pull the Nitro Stats from a VPX and parse them into
+        a SampleStore
+        With NITRO_PAGE_SIZE set, the entity list features are pulled a
+        page at a time and each page is parsed and yielded on its own,
+        so only one page of entities is held in memory at a time
+    '''
+    paged_features = []
+    if NITRO_PAGE_SIZE > 0:
+        paged_features = [f for f in features if f in NITRO_ENTITY_FEATURES]
+    stats = pull_citrixadc_metrics(vpx, [f for f in features if f not in paged_features])
+    yield parse_stats(vpx, metrics, stats)
+    for feature in paged_features:
+        for page in get_feature_stats_pages(vpx, feature):
+            yield parse_stats(vpx, metrics, {feature: page})
+
+def scrape_citrixadc_metrics_events(vpx_instances, metrics, features):
+    '''
+        Method to scrape all the VPX(s) from a single event loop
+        (COLLECTION_ENGINE = 'events'). Every VPX x feature request is
+        driven by nitroevents.fetch_all and a VPX is transformed as soon
+        as all of its features are in. Yields (vpx, samples, error)
+        like run_concurrently does
+        The event loop runs in its own thread, so the time the caller
+        spends pushing a VPX doesn't count against the Nitro timeouts of
+        the requests still in flight
+    '''
+    requests = []
+    remaining = {}
+    stats = {}
+    for index, vpx in enumerate(vpx_instances):
+        remaining[index] = len(features)
+        stats[index] = {}
+        for feature in features:
+            scheme, nsip, path, headers = get_nitro_request(vpx, feature)
+            requests.append(nitroevents.NitroRequest((index, feature), scheme, nsip, path, headers))
+
+    deadline = time.time() + SCRAPE_DEADLINE
+    responses = Queue.Queue()
+    loop_done = object()
+    loop_errors = []
+
+    def event_loop():
+        try:
+            for response in nitroevents.fetch_all(requests, MAX_INFLIGHT_REQUESTS, MAX_FEATURE_WORKERS,
+                                                  NITRO_TIMEOUT, deadline):
+                responses.put(response)
+        except Exception as e:
+            loop_errors.append(e)
+        finally:
+            responses.put(loop_done)
+
+    t = threading.Thread(target=event_loop)
+    t.daemon = True
+    t.start()
+    for response in iter(responses.get, loop_done):
+        index, feature = response.key
+        vpx = vpx_instances[index]
+        if response.error is not None:
+            logger.warn("Failed to get " + feature + " stats from " + vpx['instance-id'] + ": " + response.error)
+        elif response.status != 200:
+            logger.info("Error getting stats : Error code: " + str(response.status))
+        else:
+            logger.info("Got " + feature + " stats from " + vpx['instance-id'] +
+                        " in " + str(int(response.latency * 1000)) + "ms")
+            try:
+                body = NitroBodyReader(StringIO.StringIO(response.body),
+                                       response.headers.get('content-encoding', ''))
+                feature_stats = decode_feature_stats(vpx, feature, body.read(), body.wire_bytes)
+                if feature in feature_stats:  # Skip the features that failed to fetch
+                    stats[index][feature] = feature_stats
+            except (ValueError, zlib.error) as e:
+                logger.warn("Invalid " + feature + " stats from " + vpx['instance-id'] + ": " + str(e))
+        remaining[index] -= 1
+        if remaining[index] == 0:
+            vpx_stats = stats.pop(index)
+            try:
+                samples = parse_stats(vpx, metrics, vpx_stats)
+            except Exception as e:
+                yield vpx, None, e
                 continue
-            # Counter is from the input metrics template
-            # filled_counter is the DATADOG_TEMPLATE which is being filled
-            if counter['MetricName'] in stats[feature][feature]:
-                filled_counter['metric'] = counter['MetricName']
-                filled_counter['description'] = counter['Description']
-                filled_counter['type'] = counter['Type'].lower()
-                filled_counter['points'] = int(stats[feature][feature].get(filled_counter['metric'], 0))
-                filled_counter['host'] = vpx_instance_info['instance-id']  # Instance ID
-                filled_counter['tags'][0] = "CitrixADC-AutoScale-Group:" + vpx_instance_info['asg-name']
-                filled_counter['metric'] = DATADOG_PREFIX + '.' + filled_counter['metric']  # Prefix with citrixadc for each metric
-                filled_metrics.append(filled_counter)
-    return filled_metrics
-
-def get_each_stats_datadog(filled_counter, stats, feature, vpx_instance_info):
-    '''
-        Method to iterate through the list of entities and create metrics
-    '''
-    filled_metrics = []
-    for each_stat in stats:
-        if filled_counter['metric'] in each_stat:
-            filled_counter['points'] = int(each_stat.get(filled_counter['metric'], 0))
-            filled_counter['host'] = vpx_instance_info['instance-id']  # Instance ID
-            filled_counter['tags'][0] = "CitrixADC-AutoScale-Group:" + vpx_instance_info['asg-name']
-            # Assuming we have only 2 tags set
-            if len(filled_counter['tags']) == 3:
-                filled_counter['tags'][2] = feature + ":" + each_stat['name']
-            elif len(filled_counter['tags']) == 2:
-                filled_counter['tags'].append(feature + ":" + each_stat['name']) # Add a tag with feature:name
-            filled_counter['metric'] = DATADOG_PREFIX + '.' + filled_counter['metric']  # Prefix with citrixadc for each metric
-            filled_metrics.append(filled_counter)
-    return filled_metrics
-
-def push_metrics_cloudwatch(vpx, metrics, stats):
-    filled_metrics = parse_stats_cloudwatch(vpx, metrics, stats)
-    post_cloudwatch_metrics_data(filled_metrics)
-
-def push_metrics_datadog(vpx, metrics, stats):
-    filled_metrics = parse_stats_datadog(vpx, metrics, stats)
-    post_datadog_metrics_data(filled_metrics)
+            yield vpx, samples, None
+    if loop_errors:
+        raise loop_errors[0]
+
+def run_concurrently(func, items, max_workers):
+    '''
+        Method to call func for each of the items on a bounded pool of
+        worker threads. Yields (item, result, error) in the order the
+        items complete, so a failing or slow item doesn't stall the rest
+        If func is a generator function, each value it yields is passed
+        on as a separate result as soon as it is produced; the workers
+        wait for the caller when it falls behind
+    '''
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        for item in items:
+            try:
+                result = func(item)
+                if isinstance(result, types.GeneratorType):
+                    for chunk in result:
+                        yield item, chunk, None
+                else:
+                    yield item, result, None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    workers = min(max_workers, len(items))
+    pending = Queue.Queue()
+    completed = Queue.Queue(maxsize=2 * workers)
+    item_done = object()
+    for item in items:
+        pending.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                result = func(item)
+                if isinstance(result, types.GeneratorType):
+                    for chunk in result:
+                        completed.put((item, chunk, None))
+                else:
+                    completed.put((item, result, None))
+            except Exception as e:
+                completed.put((item, None, e))
+            completed.put(item_done)
+
+    for _ in range(workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+    done = 0
+    while done < len(items):
+        result = completed.get()
+        if result is item_done:
+            done += 1
+            continue
+        yield result
 
 def pull_citrixadc_metrics(vpx, features):
+    '''
+        Method to fetch the Nitro Stats of all the features from a VPX
+        At most MAX_FEATURE_WORKERS requests are in flight per VPX
+    '''
+    def timed_feature_stats(feature):
+        start = time.time()
+        feature_stats = get_feature_stats(vpx, feature)
+        return feature_stats, time.time() - start
+
     stats = {}
-    for feature in features:
-        stats[feature] = get_feature_stats(vpx, feature)
+    for feature, result, error in run_concurrently(timed_feature_stats, features, MAX_FEATURE_WORKERS):
+        if error is not None:
+            logger.warn("Failed to get " + feature + " stats from " + vpx['instance-id'] + ": " + str(error))
+            continue
+        feature_stats, latency = result
+        logger.info("Got " + feature + " stats from " + vpx['instance-id'] +
+                    " in " + str(int(latency * 1000)) + "ms")
+        if feature in feature_stats:  # Skip the features that failed to fetch
+            stats[feature] = feature_stats
     return stats
 
-def get_feature_stats(vpx_instance_info,feature):
+def get_nitro_attrs(metrics):
     '''
-        Method to fetch feature specific Nitro stats from VPX
+        Method to derive the Nitro attributes to request for each feature
+        from the metrics template {feature: 'attr1,attr2,...'}
+    '''
+    nitro_attrs = {}
+    for feature, counters in metrics.items():
+        attrs = sorted(set(counter['MetricName'] for counter in counters))
+        if feature in NITRO_ENTITY_FEATURES:
+            attrs.append('name')  # Needed for the per entity dimension/tag
+        nitro_attrs[feature] = ','.join(attrs)
+    return nitro_attrs
+
+NITRO_ATTRS = get_nitro_attrs(metrics_template.metrics)
+
+def get_nitro_request(vpx_instance_info, feature, pageno=None):
+    '''
+        Method to build the Nitro stat request of a feature
+        Returns (scheme, NSIP, path, headers)
     '''
     REQUEST_METHOD = "http"  # Choose protocol as http or https
     CITRIX_ADC_USERNAME = "nsroot"
@@ -217,87 +989,960 @@ def get_feature_stats(vpx_instance_info,feature):
         logger.info("Getting Stats from VPX over it's public NSIP " + vpx_instance_info['nsip-public'])
         NSIP = vpx_instance_info['nsip-public']
 
-    url = '{}://{}/nitro/v1/stat/{}/'.format(REQUEST_METHOD, NSIP, feature)
+    path = '/nitro/v1/stat/{}/'.format(feature)
+    args = []
+    if NITRO_ATTRS_PROJECTION and feature in NITRO_ATTRS:
+        args.append('attrs=' + NITRO_ATTRS[feature])
+    if pageno is not None:
+        args.append('pagesize={}&pageno={}'.format(NITRO_PAGE_SIZE, pageno))
+    if args:
+        path += '?' + '&'.join(args)
     headers = {'Content-Type': 'application/json', 'X-NITRO-USER': CITRIX_ADC_USERNAME, 'X-NITRO-PASS': CITRIX_ADC_PASSWORD}
-    r = urllib2.Request(url,  headers=headers)
+    if NITRO_COMPRESSION:
+        headers['Accept-Encoding'] = 'gzip, deflate'
+    return REQUEST_METHOD, NSIP, path, headers
+
+def get_feature_stats_pages(vpx_instance_info, feature):
+    '''
+        Method to fetch the Nitro stats of an entity list feature one
+        page of NITRO_PAGE_SIZE entities at a time
+        Stops on a page of any other size, as when Nitro ignores the
+        paging and returns the whole list, and on a page starting with
+        an entity an earlier page started with, so that the same page is
+        never pulled and pushed over and over
+    '''
+    pageno = 1
+    first_names = set()
+    while True:
+        page = get_feature_stats(vpx_instance_info, feature, pageno)
+        entities = page.get(feature)
+        if not entities:
+            return
+        if type(entities) == list:
+            first_name = entities[0].get('name')
+            if first_name in first_names:
+                logger.warn("Nitro returned an earlier page of " + feature + " as page " + str(pageno) +
+                            " of " + vpx_instance_info['instance-id'] + ", stopped paging")
+                return
+            first_names.add(first_name)
+        yield page
+        if type(entities) != list or len(entities) != NITRO_PAGE_SIZE:
+            return
+        pageno += 1
+
+def get_feature_stats(vpx_instance_info,feature, pageno=None):
+    '''
+        Method to fetch feature specific Nitro stats from VPX
+        pageno fetches just that page of NITRO_PAGE_SIZE entities
+        With NITRO_STREAM_DECODE, the entities of the NITRO_ENTITY_FEATURES
+        are returned as a generator that decodes them one at a time
+        while the response is still being received
+    '''
+    scheme, nsip, path, headers = get_nitro_request(vpx_instance_info, feature, pageno)
     try:
-        resp = urllib2.urlopen(r)
-        return json.loads(resp.read())
-    except urllib2.HTTPError as hte:
+        conn, resp = nitro_open(scheme, nsip, path, headers)
+        body = NitroBodyReader(resp, resp.getheader('content-encoding', ''))
+        if resp.status == 200 and NITRO_STREAM_DECODE and pageno is None \
+                and feature in NITRO_ENTITY_FEATURES:
+            return {feature: stream_feature_entities(vpx_instance_info, feature, scheme, nsip, conn, body)}
+        data = body.read()
+        nitro_close(scheme, nsip, conn, resp)
+        if resp.status == 200:
+            return decode_feature_stats(vpx_instance_info, feature, data, body.wire_bytes)
         logger.info("Error getting stats : Error code: " +
-                    str(hte.code) + ", reason=" + hte.reason)
+                    str(resp.status) + ", reason=" + resp.reason)
     except:
         logger.warn("Caught exception: " + str(sys.exc_info()[:2]))
     return {}
 
+def decode_feature_stats(vpx_instance_info, feature, body, wire_bytes):
+    '''
+        Method to decode a Nitro stat response body
+        Logs the bytes received (before and after decompression) and
+        the time taken to decode them
+    '''
+    start = time.time()
+    feature_stats = json.loads(body)
+    logger.info("Decoded " + feature + " stats from " + vpx_instance_info['instance-id'] + ": " +
+                str(len(body)) + " bytes (" + str(wire_bytes) + " on the wire) in " +
+                str(int((time.time() - start) * 1000)) + "ms")
+    return feature_stats
+
+class NitroBodyReader(object):
+    '''
+        File like reader of a Nitro response body that decompresses the
+        gzip/deflate Content-Encoding on the fly and counts the bytes
+        received on the wire (wire_bytes) and after decompression
+        (body_bytes)
+    '''
+    def __init__(self, resp, encoding):
+        self.resp = resp
+        self.decompressor = None
+        if encoding.lower() in ('gzip', 'deflate'):
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)  # Accepts both gzip and zlib headers
+        self.buffered = ''
+        self.wire_bytes = 0
+        self.body_bytes = 0
+
+    def read(self, size=-1):
+        if self.decompressor is None:
+            data = self.resp.read() if size < 0 else self.resp.read(size)
+            self.wire_bytes += len(data)
+            self.body_bytes += len(data)
+            return data
+        while size < 0 or len(self.buffered) < size:
+            data = self.resp.read() if size < 0 else self.resp.read(NITRO_READ_SIZE)
+            self.wire_bytes += len(data)
+            if not data:
+                self.buffered += self.decompressor.flush()
+                break
+            self.buffered += self.decompressor.decompress(data)
+        if size < 0:
+            size = len(self.buffered)
+        data, self.buffered = self.buffered[:size], self.buffered[size:]
+        self.body_bytes += len(data)
+        return data
+
+def stream_feature_entities(vpx_instance_info, feature, scheme, nsip, conn, body):
+    '''
+        Method to incrementally decode the entity list of a Nitro stat
+        response {..., "<feature>": [{entity}, {entity}, ...]}
+        Yields one entity dict at a time, reading the body in chunks of
+        NITRO_READ_SIZE bytes, so only the entity being decoded and one
+        chunk are held in memory
+    '''
+    decoder = json.JSONDecoder()
+    list_start = re.compile(r'"' + feature + r'"\s*:\s*\[')
+    buf = ''
+    entities = 0
+    start = time.time()
+
+    try:
+        # Find the start of the entity list
+        match = None
+        while match is None:
+            data = body.read(NITRO_READ_SIZE)
+            if not data:
+                nitro_close(scheme, nsip, conn, body.resp)
+                return  # No entities of this feature on the VPX
+            buf += data
+            match = list_start.search(buf)
+        pos = match.end()
+
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) and buf[pos] == ']':
+                break
+            try:
+                entity, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                data = body.read(NITRO_READ_SIZE)
+                if not data:
+                    raise
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            entities += 1
+            pos = end
+            yield entity
+
+        body.read()
+        nitro_close(scheme, nsip, conn, body.resp)
+        logger.info("Decoded " + feature + " stats from " + vpx_instance_info['instance-id'] + ": " +
+                    str(entities) + " entities, " + str(body.body_bytes) + " bytes (" +
+                    str(body.wire_bytes) + " on the wire) in " +
+                    str(int((time.time() - start) * 1000)) + "ms")
+    except (httplib.HTTPException, socket.error, ValueError, zlib.error) as e:
+        conn.close()
+        logger.warn("Failed to decode " + feature + " stats from " + vpx_instance_info['instance-id'] +
+                    " after " + str(entities) + " entities: " + str(e))
+
+def nitro_open(scheme, nsip, path, headers):
+    '''
+        Method to send a Nitro GET over a pooled keep-alive connection
+        A reused connection that turns out to be closed by the VPX is
+        dropped and the request retried on a fresh connection
+        Returns (connection, response) with the body not yet read;
+        hand both to nitro_close once done with the body
+    '''
+    while True:
+        conn, reused = get_nitro_connection(scheme, nsip)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if reused:
+                continue
+            raise
+
+def nitro_close(scheme, nsip, conn, resp):
+    '''
+        Method to read the rest of the response body and give the
+        connection back to the pool. Returns what was left of the body
+    '''
+    try:
+        body = resp.read()
+    except (httplib.HTTPException, socket.error):
+        conn.close()
+        raise
+    if resp.will_close:
+        conn.close()
+    else:
+        release_nitro_connection(scheme, nsip, conn)
+    return body
+
+def get_nitro_connection(scheme, nsip):
+    '''
+        Method to take an idle connection to the NSIP from the pool, or
+        open a new one. Returns (connection, reused)
+    '''
+    now = time.time()
+    with NITRO_CONNECTION_POOL_LOCK:
+        idle = NITRO_CONNECTION_POOL.get((scheme, nsip), [])
+        while idle:
+            conn, last_used = idle.pop()
+            if now - last_used < KEEPALIVE_IDLE_TIMEOUT and not is_connection_stale(conn):
+                return conn, True
+            conn.close()
+    if scheme == 'https':
+        context = ssl._create_unverified_context()  # VPX(s) serve a self signed certificate
+        return httplib.HTTPSConnection(nsip, timeout=NITRO_TIMEOUT, context=context), False
+    return httplib.HTTPConnection(nsip, timeout=NITRO_TIMEOUT), False
+
+def release_nitro_connection(scheme, nsip, conn):
+    '''
+        Method to return a connection to the pool for reuse
+        At most MAX_FEATURE_WORKERS idle connections are kept per NSIP
+    '''
+    with NITRO_CONNECTION_POOL_LOCK:
+        idle = NITRO_CONNECTION_POOL.setdefault((scheme, nsip), [])
+        if len(idle) < MAX_FEATURE_WORKERS:
+            idle.append((conn, time.time()))
+            return
+    conn.close()
+
+def is_connection_stale(conn):
+    '''
+        An idle keep-alive connection should have nothing to read
+        If the socket is readable the VPX has closed it (or sent junk)
+    '''
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
 def get_vpx_instances(vpx_asg_name):
     '''
         Get all the VPX instances in the provided AutoScale Group
+        Served from DISCOVERY_CACHE while it's fresh, see DISCOVERY_CACHE_TTL
     '''
-    result = []
+    now = time.time()
+    cached = DISCOVERY_CACHE.get(vpx_asg_name)
+    if cached is not None and now - cached['checked'] < DISCOVERY_CACHE_TTL:
+        DISCOVERY_CACHE_STATS['hits'] += 1
+        log_discovery_cache(vpx_asg_name, "hit")
+        return cached['instances']
+
     logger.info("Looking for instances in ASG:" + vpx_asg_name)
-    groups = asg_client.describe_auto_scaling_groups(AutoScalingGroupNames=[vpx_asg_name])
-    for group in groups['AutoScalingGroups']:
-        instances = group['Instances']
-        for instance in instances:
-            instance_info = {}
-            instance_id = instance['InstanceId']
-            instance_info['instance-id'] = instance_id
-            instance_info['asg-name'] = vpx_asg_name
-            instance_info['availability-zone'] = instance['AvailabilityZone']
-            ec2_reservations = ec2_client.describe_instances(InstanceIds=[instance_id])
-            for reservation in ec2_reservations['Reservations']:
-                ec2_instances = reservation['Instances']
-                for ec2_instance in ec2_instances:
-                    ec2_instance_id = ec2_instance['InstanceId']
-                    logger.info("Found ec2_instance " + ec2_instance_id +
-                                " in ASG " + vpx_asg_name + ", state=" +
-                                ec2_instance['State']['Name'])
-                    if ec2_instance['State']['Name'] != 'running':
-                        continue
-                    net_if = ec2_instance['NetworkInterfaces'][0]  # Assume interface #0 = nsip
-                    logger.info("Found net interface for " + ec2_instance_id +
-                                ", state=" + net_if['Status'])
-                    if net_if['Status'] == 'in-use':
-                        nsip_public = net_if['PrivateIpAddresses'][0].get('Association',{})
-                        nsip_public = nsip_public.get('PublicIp', "")
-                        nsip = net_if['PrivateIpAddresses'][0]['PrivateIpAddress']
-                        logger.info("Found Private NSIP ip for " + ec2_instance_id + ": " + nsip)
-                        instance_info['nsip'] = nsip
-                        instance_info['nsip-public'] = nsip_public
-                        if nsip_public is not "":
-                            logger.info("Found Public NSIP ip for " + ec2_instance_id + ": " + nsip_public)
-                        result.append(instance_info)
+    groups = []
+    paginator = asg_client.get_paginator('describe_auto_scaling_groups')
+    for page in paginator.paginate(AutoScalingGroupNames=[vpx_asg_name]):
+        groups.extend(page['AutoScalingGroups'])
+    fingerprint = get_asg_fingerprint(groups)
+    if cached is not None and cached['fingerprint'] == fingerprint:
+        DISCOVERY_CACHE_STATS['hits'] += 1
+        cached['checked'] = now
+        log_discovery_cache(vpx_asg_name, "hit, ASG unchanged")
+        return cached['instances']
+
+    DISCOVERY_CACHE_STATS['misses'] += 1
+    asg_instances = []
+    for group in groups:
+        asg_instances.extend(group['Instances'])
+    instances = describe_vpx_instances(vpx_asg_name, asg_instances)
+    DISCOVERY_CACHE[vpx_asg_name] = {'fingerprint': fingerprint, 'instances': instances, 'checked': now}
+    log_discovery_cache(vpx_asg_name, "miss")
+    return instances
+
+def get_asg_fingerprint(groups):
+    '''
+        Method to summarize what the discovered VPX(s) depend on: the
+        member instances and their lifecycle state, the launch
+        configuration/template and the desired capacity
+    '''
+    fingerprint = []
+    for group in groups:
+        fingerprint.append((
+            tuple(sorted((i['InstanceId'], i.get('LifecycleState')) for i in group['Instances'])),
+            group.get('LaunchConfigurationName'),
+            json.dumps(group.get('LaunchTemplate'), sort_keys=True),
+            group.get('DesiredCapacity')))
+    return fingerprint
+
+def log_discovery_cache(vpx_asg_name, result):
+    logger.info("VPX discovery cache " + result + " for ASG " + vpx_asg_name +
+                " (hits=" + str(DISCOVERY_CACHE_STATS['hits']) +
+                ", misses=" + str(DISCOVERY_CACHE_STATS['misses']) + ")")
+
+def describe_vpx_instances(vpx_asg_name, asg_instances):
+    '''
+        Method to find the NSIP(s) of the AutoScale Group instances
+        The instances are described DESCRIBE_INSTANCES_BATCH_SIZE at a
+        time instead of one describe_instances call per instance
+    '''
+    instance_ids = [instance['InstanceId'] for instance in asg_instances]
+    ec2_instances = {}
+    paginator = ec2_client.get_paginator('describe_instances')
+    for batch in split_metrics_list(instance_ids, DESCRIBE_INSTANCES_BATCH_SIZE):
+        for page in paginator.paginate(InstanceIds=batch):
+            for reservation in page['Reservations']:
+                for ec2_instance in reservation['Instances']:
+                    ec2_instances[ec2_instance['InstanceId']] = ec2_instance
+
+    result = []
+    for instance in asg_instances:
+        instance_info = {}
+        instance_id = instance['InstanceId']
+        instance_info['instance-id'] = instance_id
+        instance_info['asg-name'] = vpx_asg_name
+        instance_info['availability-zone'] = instance['AvailabilityZone']
+        ec2_instance = ec2_instances.get(instance_id)
+        if ec2_instance is None:
+            continue
+        launch_time = ec2_instance.get('LaunchTime')
+        # Seconds since epoch, what the Nitro totals count from
+        instance_info['launch-time'] = calendar.timegm(launch_time.utctimetuple()) if launch_time else None
+        logger.info("Found ec2_instance " + instance_id +
+                    " in ASG " + vpx_asg_name + ", state=" +
+                    ec2_instance['State']['Name'])
+        if ec2_instance['State']['Name'] != 'running':
+            continue
+        net_if = ec2_instance['NetworkInterfaces'][0]  # Assume interface #0 = nsip
+        logger.info("Found net interface for " + instance_id +
+                    ", state=" + net_if['Status'])
+        if net_if['Status'] == 'in-use':
+            nsip_public = net_if['PrivateIpAddresses'][0].get('Association',{})
+            nsip_public = nsip_public.get('PublicIp', "")
+            nsip = net_if['PrivateIpAddresses'][0]['PrivateIpAddress']
+            logger.info("Found Private NSIP ip for " + instance_id + ": " + nsip)
+            instance_info['nsip'] = nsip
+            instance_info['nsip-public'] = nsip_public
+            if nsip_public is not "":
+                logger.info("Found Public NSIP ip for " + instance_id + ": " + nsip_public)
+            result.append(instance_info)
     return result
 
-def split_metrics_list(metrics, size=20):
+def split_metrics_list(metrics, size):
+    '''
+        Method to split a list (or any iterable) into chunks of specified size
+    '''
+    metrics = iter(metrics)
+    while True:
+        chunk = list(itertools.islice(metrics, size))
+        if not chunk:
+            return
+        yield chunk
+
+def split_metrics_batches(metrics, max_count, max_bytes, sizeof, overhead=0):
+    '''
+        Method to split an iterable of metrics into batches of at most
+        max_count metrics and max_bytes bytes, sizeof(metric) being the
+        bytes a metric adds to a request and overhead those of the
+        request itself. Yields (batch, bytes)
+    '''
+    batch = []
+    size = overhead
+    for metric in metrics:
+        metric_size = sizeof(metric)
+        if batch and (len(batch) >= max_count or size + metric_size > max_bytes):
+            yield batch, size
+            batch = []
+            size = overhead
+        batch.append(metric)
+        size += metric_size
+    if batch:
+        yield batch, size
+
+def get_query_size(value, cache):
+    '''
+        Method to get the length of a value once query (form) encoded
+        cache maps the values already seen to their length
+    '''
+    size = cache.get(value)
+    if size is None:
+        if isinstance(value, unicode):
+            size = len(urllib.quote(value.encode('utf-8'), safe='-_.~'))
+        else:
+            size = len(urllib.quote(str(value), safe='-_.~'))
+        cache[value] = size
+    return size
+
+'''
+    Query encoded size of the parts of a PutMetricData metric that do not
+    depend on its values. Member indexes are counted at 4 digits and the
+    timestamp as %Y-%m-%dT%H%3A%M%3A%S.%fZ
+'''
+CLOUDWATCH_MEMBER_SIZE = len('&MetricData.member.1000.')
+CLOUDWATCH_DATUM_SIZE = (3 * CLOUDWATCH_MEMBER_SIZE + len('MetricName=') + len('Unit=') +
+                         len('Timestamp=') + len('2019-01-01T00%3A00%3A00.000000Z'))
+CLOUDWATCH_VALUE_SIZE = CLOUDWATCH_MEMBER_SIZE + len('Value=')
+CLOUDWATCH_VALUES_SIZE = CLOUDWATCH_MEMBER_SIZE + len('Values.member.150=')
+CLOUDWATCH_STATISTIC_SIZE = CLOUDWATCH_MEMBER_SIZE + len('StatisticValues.SampleCount=')
+CLOUDWATCH_DIMENSION_SIZE = 2 * CLOUDWATCH_MEMBER_SIZE + len('Dimensions.member.10.Name=') + \
+    len('Dimensions.member.10.Value=')
+
+def get_cloudwatch_datum_size(datum, cache):
     '''
-        Method to split a list into chunks of specified size
+        Method to get the bytes a metric adds to a PutMetricData request
     '''
-    for i in range(0, len(metrics), size):
-        yield metrics[i:i + size]
+    size = CLOUDWATCH_DATUM_SIZE + get_query_size(datum['MetricName'], cache) + \
+        get_query_size(datum['Unit'], cache)
+    if 'Value' in datum:
+        size += CLOUDWATCH_VALUE_SIZE + get_query_size(datum['Value'], cache)
+    elif 'Values' in datum:
+        for value in itertools.chain(datum['Values'], datum['Counts']):
+            size += CLOUDWATCH_VALUES_SIZE + get_query_size(value, cache)
+    else:
+        for value in datum['StatisticValues'].itervalues():
+            size += CLOUDWATCH_STATISTIC_SIZE + get_query_size(value, cache)
+    for dimension in datum['Dimensions']:
+        size += CLOUDWATCH_DIMENSION_SIZE + get_query_size(dimension['Name'], cache) + \
+            get_query_size(dimension['Value'], cache)
+    return size
 
 def post_cloudwatch_metrics_data(metricData, namespace=CLOUDWATCH_NAMESPACE):
     '''
         Method to push the metrics to Cloud Watch
     '''
-    if (len(metricData) > 20):
-        '''
-            The max metric list length is 20 for AWS CloudWatch
-            So splitting list into lengths of 20 and 
-            pushing multiple times if the length is greater than 20
-        '''
-        chuncked_metricData = split_metrics_list(metricData)
-        for data in chuncked_metricData:
+    '''
+        The metrics are pushed in as few PutMetricData requests as the
+        CLOUDWATCH_MAX_DATUMS and CLOUDWATCH_MAX_PAYLOAD limits allow,
+        CLOUDWATCH_PUT_WORKERS of them at a time
+        A batch that fails is logged and, unless Cloud Watch refused it,
+        spilled to be pushed again (see SPILL_DIR); the others still go out
+    '''
+    put = lambda batch: put_cloudwatch_metrics_batch(batch[0], namespace)
+    failed = []
+    for (data, size), push_out, error in run_concurrently(put, split_cloudwatch_batches(metricData, namespace),
+                                                          CLOUDWATCH_PUT_WORKERS):
+        CLOUDWATCH_PUT_STATS['batches'] += 1
+        CLOUDWATCH_PUT_STATS['metrics'] += len(data)
+        CLOUDWATCH_PUT_STATS['bytes'] += size
+        if error is not None:
+            CLOUDWATCH_PUT_STATS['failed'] += 1
+            logger.warn("Failed to push " + str(len(data)) + " Metrics to Cloud Watch: " + str(error))
+            if is_transient_error(error):
+                failed.extend(data)
+            continue
+        logger.info("Result of Pushing " + str(len(data)) + " Metrics (" + str(size) +
+                    " bytes) to Cloud Watch: " + str(push_out))
+    if failed:
+        spill_batch('cloudwatch', failed)
+
+def replay_cloudwatch_metrics_data(metricData, namespace=CLOUDWATCH_NAMESPACE):
+    '''
+        Method to push spilled metrics to Cloud Watch again, one batch
+        at a time, stopping at the first batch that fails
+        Returns the metrics to spill again
+    '''
+    unsent = []
+    for data, size in split_cloudwatch_batches(metricData, namespace):
+        if unsent:
+            unsent.extend(data)
+            continue
+        try:
+            put_cloudwatch_metrics_batch(data, namespace)
+        except Exception as e:
+            logger.warn("Failed to push " + str(len(data)) + " spilled Metrics to Cloud Watch: " + str(e))
+            if is_transient_error(e):
+                unsent.extend(data)
+    return unsent
+
+def split_cloudwatch_batches(metricData, namespace):
+    '''
+        Method to split metrics into PutMetricData batches, see
+        split_metrics_batches
+    '''
+    cache = {}
+    overhead = len('Action=PutMetricData&Version=2010-08-01&Namespace=') + get_query_size(namespace, cache)
+    return split_metrics_batches(metricData, CLOUDWATCH_MAX_DATUMS, CLOUDWATCH_MAX_PAYLOAD,
+                                 lambda datum: get_cloudwatch_datum_size(datum, cache), overhead)
+
+def is_transient_error(e):
+    '''
+        Method to tell whether a failed AWS request may go through later:
+        throttling, server side (5xx) and connection errors
+    '''
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return True
+    if response.get('Error', {}).get('Code') in CLOUDWATCH_THROTTLING_ERRORS:
+        return True
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) >= 500
+
+def put_cloudwatch_metrics_batch(data, namespace):
+    '''
+        Method to send a PutMetricData request, retrying it with backoff
+        while it is throttled (see CLOUDWATCH_PUT_RETRIES)
+    '''
+    retries = 0
+    while True:
+        delay = CLOUDWATCH_BACKOFF['delay']
+        if delay > 0:
+            time.sleep(random.uniform(0, delay))
+        try:
             push_out = cw_client.put_metric_data(Namespace=namespace, MetricData=data)
-            logger.info("Result of Pushing Metrics to Cloud Watch: " + str(push_out))
-    else:
-        push_out = cw_client.put_metric_data(Namespace=namespace, MetricData=metricData)
-        logger.info("Result of Pushing Metrics to Cloud Watch: " + str(push_out))
+        except Exception as e:
+            error_code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if error_code not in CLOUDWATCH_THROTTLING_ERRORS or retries >= CLOUDWATCH_PUT_RETRIES:
+                raise
+            with CLOUDWATCH_BACKOFF_LOCK:
+                CLOUDWATCH_BACKOFF['delay'] = min(CLOUDWATCH_BACKOFF_CAP,
+                                                  max(CLOUDWATCH_BACKOFF_BASE, CLOUDWATCH_BACKOFF['delay'] * 2))
+                CLOUDWATCH_PUT_STATS['retries'] += 1
+            retries += 1
+            continue
+        with CLOUDWATCH_BACKOFF_LOCK:
+            delay = CLOUDWATCH_BACKOFF['delay'] / 2
+            CLOUDWATCH_BACKOFF['delay'] = delay if delay >= CLOUDWATCH_BACKOFF_BASE else 0.0
+        return push_out
+
+def log_cloudwatch_put_stats():
+    logger.info("PutMetricData summary: batches=" + str(CLOUDWATCH_PUT_STATS['batches']) +
+                ", metrics=" + str(CLOUDWATCH_PUT_STATS['metrics']) +
+                ", bytes=" + str(CLOUDWATCH_PUT_STATS['bytes']) +
+                ", retries=" + str(CLOUDWATCH_PUT_STATS['retries']) +
+                ", failed=" + str(CLOUDWATCH_PUT_STATS['failed']))
+
+def post_emf_metrics_data(documents):
+    '''
+        Method to push EMF documents to CloudWatch: they are written to
+        stdout, one per line, and CloudWatch Logs extracts the metrics
+        from the Lambda's log group
+    '''
+    count = 0
+    for document in documents:
+        sys.stdout.write(document + '\n')
+        count += 1
+    sys.stdout.flush()
+    logger.info("Wrote " + str(count) + " EMF documents to the log")
 
 def post_datadog_metrics_data(metricData):
-    push_out = api.Metric.send(metricData)
+    '''
+        Method to push the series to Datadog, spilled to be pushed again
+        (see SPILL_DIR) when Datadog doesn't take them
+    '''
+    metricData = list(metricData)
+    if replay_datadog_metrics_data(metricData):
+        spill_batch('datadog', metricData)
+
+def replay_datadog_metrics_data(metricData):
+    '''
+        Method to send series to Datadog
+        Returns the series to spill (again): all of them on failure
+    '''
+    try:
+        push_out = api.Metric.send(metricData)
+    except Exception as e:
+        push_out = {'errors': [str(e)]}
     logger.info("Result of Pushing Metrics to Datadog: " + str(push_out))
+    if isinstance(push_out, dict) and push_out.get('errors'):
+        return metricData
+    return []
+
+def post_dogstatsd_metrics_data(lines):
+    '''
+        Method to push DogStatsD lines, packed into as few datagrams as
+        DOGSTATSD_MAX_DATAGRAM allows, over a non-blocking UDP socket
+    '''
+    global DOGSTATSD_SOCKET
+    if DOGSTATSD_SOCKET is None:
+        DOGSTATSD_SOCKET = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        DOGSTATSD_SOCKET.setblocking(0)
+    address = (DOGSTATSD_HOST, DOGSTATSD_PORT)
+    metrics = datagrams = dropped = 0
+    for datagram in split_dogstatsd_datagrams(lines, DOGSTATSD_MAX_DATAGRAM):
+        metrics += datagram.count('\n') + 1
+        datagrams += 1
+        try:
+            DOGSTATSD_SOCKET.sendto(datagram, address)
+        except socket.error:
+            dropped += 1
+    logger.info("Sent " + str(metrics) + " metrics in " + str(datagrams) + " datagrams to DogStatsD" +
+                (", " + str(dropped) + " dropped" if dropped else ""))
+
+def split_dogstatsd_datagrams(lines, max_bytes):
+    '''
+        Method to pack lines into newline separated datagrams of at most
+        max_bytes bytes; a longer line goes in a datagram of its own
+    '''
+    datagram = []
+    size = 0
+    for line in lines:
+        if datagram and size + 1 + len(line) > max_bytes:
+            yield '\n'.join(datagram)
+            datagram = []
+            size = 0
+        size += len(line) + (1 if datagram else 0)
+        datagram.append(line)
+    if datagram:
+        yield '\n'.join(datagram)
+
+def post_prometheus_metrics_data(series):
+    '''
+        Method to push remote write TimeSeries to PROMETHEUS_REMOTE_WRITE_URL
+        in snappy compressed WriteRequests, one at a time
+    '''
+    for batch, size in split_metrics_batches(series, PROMETHEUS_MAX_SERIES, PROMETHEUS_MAX_BYTES, len):
+        payload = remotewrite.snappy_compress(''.join(batch))
+        sizes = " (" + str(len(payload)) + " bytes, " + str(size) + " uncompressed)"
+        try:
+            status, body = send_prometheus_write_request(payload)
+        except (socket.error, httplib.HTTPException) as e:
+            logger.warn("Prometheus rejected " + str(len(batch)) + " series" + sizes + ": " + str(e))
+            continue
+        if status // 100 != 2:
+            logger.warn("Prometheus rejected " + str(len(batch)) + " series" + sizes + ": HTTP " +
+                        str(status) + " " + body)
+            continue
+        logger.info("Prometheus accepted " + str(len(batch)) + " series" + sizes)
+
+def send_prometheus_write_request(payload):
+    '''
+        Method to POST a snappy compressed WriteRequest
+        Returns (HTTP status, response body)
+    '''
+    headers = {
+        'Content-Type': 'application/x-protobuf',
+        'Content-Encoding': 'snappy',
+        'X-Prometheus-Remote-Write-Version': '0.1.0'
+    }
+    if PROMETHEUS_TENANT:
+        headers['X-Scope-OrgID'] = PROMETHEUS_TENANT
+    if PROMETHEUS_BEARER_TOKEN:
+        headers['Authorization'] = 'Bearer ' + PROMETHEUS_BEARER_TOKEN
+    return http_post(PROMETHEUS_REMOTE_WRITE_URL, payload, headers, PROMETHEUS_TIMEOUT)
+
+def post_otlp_metrics_data(resources):
+    '''
+        Method to push OTLP ResourceMetrics: they are held until the end
+        of the invocation, see flush_otlp_metrics_data
+    '''
+    OTLP_PENDING.extend(resources)
+
+def flush_otlp_metrics_data():
+    '''
+        Method to export the ResourceMetrics pushed during the invocation
+        to OTLP_ENDPOINT, in a single request unless it would be larger
+        than OTLP_MAX_BYTES
+    '''
+    pending = OTLP_PENDING[:]
+    del OTLP_PENDING[:]
+    for batch, size in split_metrics_batches(pending, max(1, len(pending)), OTLP_MAX_BYTES, len):
+        payload = ''.join(batch)
+        headers = dict(OTLP_HEADERS)
+        headers['Content-Type'] = 'application/x-protobuf'
+        if OTLP_COMPRESSION == 'gzip':
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            headers['Content-Encoding'] = 'gzip'
+        sizes = " (" + str(len(payload)) + " bytes, " + str(size) + " uncompressed)"
+        try:
+            status, body = http_post(OTLP_ENDPOINT, payload, headers, OTLP_TIMEOUT)
+        except (socket.error, httplib.HTTPException) as e:
+            logger.warn("OTLP export of " + str(len(batch)) + " VPX(s) failed" + sizes + ": " + str(e))
+            continue
+        if status // 100 != 2:
+            logger.warn("OTLP export of " + str(len(batch)) + " VPX(s) rejected" + sizes + ": HTTP " +
+                        str(status) + " " + body)
+            continue
+        logger.info("OTLP export of " + str(len(batch)) + " VPX(s) accepted" + sizes)
+
+def http_post(url, body, headers, timeout):
+    '''
+        Method to POST body to an http(s) URL
+        Returns (HTTP status, response body)
+    '''
+    url = urlparse.urlsplit(url)
+    if url.scheme == 'https':
+        conn = httplib.HTTPSConnection(url.netloc, timeout=timeout)
+    else:
+        conn = httplib.HTTPConnection(url.netloc, timeout=timeout)
+    try:
+        conn.request('POST', url.path + ('?' + url.query if url.query else ''), body, headers)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+def split_datadog_series_batches(series, max_bytes, max_raw):
+    '''
+        Method to pack JSON encoded series into gzip compressed v2
+        series payloads of at most max_bytes bytes, max_raw uncompressed
+        Yields (payload, number of series, uncompressed bytes)
+    '''
+    '''
+        The compressed size of what is still buffered in the compressor
+        isn't known, so it is counted at its uncompressed size; when that
+        would overflow the payload the compressor is flushed to find out
+        the exact size before closing the payload
+    '''
+    compressor = None
+    chunks = []
+    emitted = pending = raw = count = 0
+    for each in series:
+        size = len(each) + 1 + DATADOG_GZIP_MARGIN
+        if compressor is not None:
+            if emitted + pending + size > max_bytes:
+                chunks.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+                emitted += len(chunks[-1])
+                pending = 0
+            if emitted + size > max_bytes or raw + size > max_raw:
+                chunks.append(compressor.compress(']}') + compressor.flush())
+                yield ''.join(chunks), count, raw + 2
+                compressor = None
+        if compressor is None:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            chunks = [compressor.compress('{"series":[')]
+            emitted = len(chunks[0])
+            pending = raw = len('{"series":[')
+            count = 0
+        if count:
+            each = ',' + each
+        chunks.append(compressor.compress(each))
+        emitted += len(chunks[-1])
+        pending += len(each)
+        raw += len(each)
+        count += 1
+    if compressor is not None:
+        chunks.append(compressor.compress(']}') + compressor.flush())
+        yield ''.join(chunks), count, raw + 2
+
+def post_datadog_v2_metrics_data(series):
+    '''
+        Method to push the series to the Datadog v2 series intake,
+        DATADOG_SEND_WORKERS payloads at a time
+    '''
+    batches = split_datadog_series_batches(series, DATADOG_MAX_PAYLOAD, DATADOG_MAX_RAW)
+    for (payload, count, raw), response, error in run_concurrently(send_datadog_v2_payload, batches,
+                                                                    DATADOG_SEND_WORKERS):
+        sizes = " (" + str(len(payload)) + " bytes, " + str(raw) + " uncompressed)"
+        if error is not None:
+            logger.warn("Datadog rejected " + str(count) + " series" + sizes + ": " + str(error))
+            continue
+        status, body = response
+        if status != 202:
+            logger.warn("Datadog rejected " + str(count) + " series" + sizes + ": HTTP " +
+                        str(status) + " " + body)
+            continue
+        try:
+            accepted = json.loads(body) if body else {}
+        except ValueError:
+            accepted = None
+        if not isinstance(accepted, dict):
+            logger.warn("Datadog accepted " + str(count) + " series" + sizes + " with an unexpected response: " +
+                        body)
+            continue
+        errors = accepted.get('errors')
+        if errors:
+            logger.warn("Datadog accepted " + str(count) + " series" + sizes + " with errors: " + str(errors))
+        else:
+            logger.info("Datadog accepted " + str(count) + " series" + sizes)
+
+def send_datadog_v2_payload(batch):
+    '''
+        Method to POST a payload of split_datadog_series_batches
+        Returns (HTTP status, response body)
+    '''
+    payload = batch[0]
+    conn = httplib.HTTPSConnection('api.' + DATADOG_SITE, timeout=DATADOG_TIMEOUT)
+    try:
+        conn.request('POST', '/api/v2/series', payload, {
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip',
+            'DD-API-KEY': os.environ.get('DATADOG_API_KEY', '')
+        })
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+'''
+    The sinks metrics can be pushed to: {name: (encoder, publisher)}
+    The encoder turns samples into an iterator of the sink's metrics and
+    the publisher pushes those metrics out
+'''
+SINKS = {
+    'cloudwatch': (encode_cloudwatch if CLOUDWATCH_COMPACTION == 'none' else encode_cloudwatch_compact,
+                   post_cloudwatch_metrics_data),
+    'emf': (encode_emf, post_emf_metrics_data),
+    'datadog': (encode_datadog, post_datadog_metrics_data),
+    'datadog-v2': (encode_datadog_v2, post_datadog_v2_metrics_data),
+    'dogstatsd': (encode_dogstatsd, post_dogstatsd_metrics_data),
+    'prometheus': (encode_prometheus, post_prometheus_metrics_data),
+    'otlp': (encode_otlp, post_otlp_metrics_data)
+}
+
+'''
+    The sinks whose failed pushes are spilled, with the method pushing
+    spilled metrics again: {name: replay}
+'''
+SPILL_REPLAYS = {
+    'cloudwatch': replay_cloudwatch_metrics_data,
+    'datadog': replay_datadog_metrics_data
+}
+
+def spill_batch(sink, batch, created=None, evict=True):
+    '''
+        Method to write metrics a sink failed to push to SPILL_DIR, as
+        JSON, <sink>.<created ms>.<sequence>.json
+        created (epoch seconds) keeps the age of metrics spilled again
+        Returns whether they were spilled; a failed spill leaves no file
+    '''
+    if not SPILL_DIR:
+        return False
+    if created is None:
+        created = time.time()
+    path = os.path.join(SPILL_DIR, '%s.%013d.%06d.json' % (sink, int(created * 1000), next(SPILL_SEQUENCE)))
+    try:
+        if not os.path.isdir(SPILL_DIR):
+            os.makedirs(SPILL_DIR)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(batch, f, default=get_epoch)  # Cloud Watch Timestamp(s) are datetime(s)
+        os.rename(path + '.tmp', path)
+    except Exception as e:
+        remove_spilled_batch(path + '.tmp')
+        logger.warn("Failed to spill " + str(len(batch)) + " " + sink + " metrics: " + str(e))
+        return False
+    logger.info("Spilled " + str(len(batch)) + " " + sink + " metrics to " + path)
+    if evict:
+        evict_spilled_batches()
+    return True
+
+def list_spilled_batches():
+    '''
+        Method to list the spilled batches, oldest first
+        [(created, sink, path, bytes)]
+    '''
+    try:
+        names = os.listdir(SPILL_DIR)
+    except OSError:
+        return []
+    batches = []
+    for name in names:
+        parts = name.split('.')
+        if len(parts) != 4 or parts[3] != 'json':
+            continue
+        path = os.path.join(SPILL_DIR, name)
+        try:
+            batches.append((int(parts[1]) / 1000.0, parts[0], path, os.path.getsize(path)))
+        except (OSError, ValueError):
+            continue
+    batches.sort()
+    return batches
+
+def evict_spilled_batches():
+    '''
+        Method to drop the spilled batches older than SPILL_MAX_AGE and,
+        oldest first, those over SPILL_MAX_BYTES
+    '''
+    now = time.time()
+    batches = list_spilled_batches()
+    total = sum(size for _, _, _, size in batches)
+    for created, sink, path, size in batches:
+        expired = now - created > SPILL_MAX_AGE
+        if not expired and total <= SPILL_MAX_BYTES:
+            break
+        remove_spilled_batch(path)
+        total -= size
+        logger.warn("Dropped spilled " + sink + " batch " + path +
+                    (", older than SPILL_MAX_AGE" if expired else ", over SPILL_MAX_BYTES"))
+
+def remove_spilled_batch(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def publish_samples(sinks, vpx, stores):
+    '''
+        Method to encode and push the samples of a VPX, its SampleStore(s)
+        of the scrape rounds, to each of the sinks. A sink failing is
+        logged and doesn't keep the samples from the other sinks, or the
+        other VPX(s) from being pushed
+    '''
+    for sink in sinks:
+        encode, publish = SINKS[sink]
+        try:
+            publish(encode(stores[0] if len(stores) == 1 else itertools.chain.from_iterable(stores)))
+        except Exception as e:
+            logger.warn("Failed to push VPX " + vpx['instance-id'] + " to " + sink + ": " + str(e))
+
+def replay_spilled_batches(sinks):
+    '''
+        Method to push the spilled metrics of the sinks again, oldest
+        first, a batch of up to SPILL_REPLAY_BYTES of spilled metrics at
+        a time. A sink still failing keeps what it didn't take spilled,
+        with its age, for the next invocation
+        A replay raising is logged, like in publish_samples, and the
+        batch(es) it was replaying are dropped, so that they don't fail
+        every invocation until SPILL_MAX_AGE
+    '''
+    if not SPILL_DIR:
+        return
+    evict_spilled_batches()
+    batches = list_spilled_batches()
+    for sink in sinks:
+        replay = SPILL_REPLAYS.get(sink)
+        spilled = [batch for batch in batches if batch[1] == sink]
+        paths = []
+        try:
+            while replay is not None and spilled:
+                created = spilled[0][0]
+                metrics, paths, size = [], [], 0
+                while spilled and (not paths or size + spilled[0][3] <= SPILL_REPLAY_BYTES):
+                    _, _, path, batch_size = spilled.pop(0)
+                    try:
+                        with open(path) as f:
+                            batch = json.load(f)
+                        if type(batch) != list:
+                            raise ValueError("not a list of metrics")
+                    except (IOError, ValueError) as e:
+                        logger.warn("Dropped unreadable spilled " + sink + " batch " + path + ": " + str(e))
+                        remove_spilled_batch(path)
+                        continue
+                    metrics.extend(batch)
+                    paths.append(path)
+                    size += batch_size
+                unsent = replay(metrics) if metrics else []
+                if unsent and not spill_batch(sink, unsent, created, evict=False):
+                    return  # Keep the spilled batches as they are
+                for path in paths:
+                    remove_spilled_batch(path)
+                if unsent:
+                    evict_spilled_batches()
+                logger.info("Pushed " + str(len(metrics) - len(unsent)) + " spilled " + sink + " metrics from " +
+                            str(len(paths)) + " batch(es)" +
+                            (", " + str(len(unsent)) + " spilled again" if unsent else ""))
+                if unsent:
+                    break
+        except Exception as e:
+            for path in paths:
+                remove_spilled_batch(path)
+            logger.warn("Failed to replay spilled " + sink + " metrics, dropped " + ", ".join(paths) + ": " + str(e))
+
+'''
+    The sinks that hold the metrics pushed during an invocation and send
+    them at its end: {name: flush}
+'''
+SINK_FLUSHES = {
+    'otlp': flush_otlp_metrics_data
+}
 
 def lambda_handler(event, context):
     logger.info(str(event))
@@ -315,8 +1960,12 @@ def lambda_handler(event, context):
     PUSH_TO_CLOUDWATCH = True
 
     # Check if Datadog's API Key is provided in the ENV
+    # (not needed by DogStatsD, the Datadog agent/extension holds it)
     DATADOG_API_KEY = os.environ.get('DATADOG_API_KEY', '')
-    if DATADOG_API_KEY == '':
+    if DATADOG_SINK == 'dogstatsd':
+        logger.info("Pushing metrics to Datadog also, through DogStatsD")
+        PUSH_TO_DATADOG = True
+    elif DATADOG_API_KEY == '':
         logger.warn("Could not push metrics to Datadog. Please provide the DataDog API Key in the ENV")
     else:
         logger.info("Pushing metrics to Datadog also")
@@ -334,8 +1983,8 @@ def lambda_handler(event, context):
         4. Push the Metrics to CloudWatch
         5. Push to Metrics to Datadog (if enabled)
     '''
-    # Import the Metrics Template from the Lambda deployment package
-    metrics = metrics_template.metrics
+    # Metrics Template from the Lambda deployment package, compiled at import
+    metrics = METRIC_PLAN
     
     # Filter out the included features alone
     features = metrics.keys()
@@ -347,11 +1996,61 @@ def lambda_handler(event, context):
     else:
         selected_features = features
 
+    sinks = []
+    CLOUDWATCH_PUT_STATS.update(dict.fromkeys(CLOUDWATCH_PUT_STATS, 0))
+    if PUSH_TO_CLOUDWATCH:
+        sinks.append('emf' if CLOUDWATCH_SINK == 'emf' else 'cloudwatch')
+    if PUSH_TO_DATADOG:
+        if DATADOG_SINK == 'v2':
+            sinks.append('datadog-v2')
+        elif DATADOG_SINK == 'dogstatsd':
+            sinks.append('dogstatsd')
+        else:
+            sinks.append('datadog')
+    if PROMETHEUS_REMOTE_WRITE_URL:
+        sinks.append('prometheus')
+    if OTLP_ENDPOINT:
+        sinks.append('otlp')
+
+    # Push what the sinks failed to take in the previous invocations first
+    replay_spilled_batches(sinks)
+
     # Get all Citrix ADC VPX from the provided AWS Autoscale Group
     vpx_instances = get_vpx_instances(asg_name)
-    for vpx in vpx_instances:
-        stats = pull_citrixadc_metrics(vpx, selected_features)
-        if PUSH_TO_CLOUDWATCH:
-            push_metrics_cloudwatch(vpx, metrics, stats)
-        if PUSH_TO_DATADOG:
-            push_metrics_datadog(vpx, metrics, stats)
+
+    # Scrape the VPX(s) in parallel and push each one's metrics as it completes
+    # With SCRAPE_ROUNDS > 1 a VPX's metrics are pushed after the last round
+    started = time.time()
+    rounds = collections.OrderedDict()  # instance-id -> SampleStore(s) of the rounds
+    for scrape_round in range(SCRAPE_ROUNDS):
+        if scrape_round > 0:
+            time.sleep(max(0, started + scrape_round * SCRAPE_INTERVAL - time.time()))
+        if COLLECTION_ENGINE == 'events':
+            scraped = scrape_citrixadc_metrics_events(vpx_instances, metrics, selected_features)
+        else:
+            scrape = lambda vpx: scrape_citrixadc_metrics(vpx, metrics, selected_features)
+            scraped = run_concurrently(scrape, vpx_instances, MAX_SCRAPE_WORKERS)
+        for vpx, samples, error in scraped:
+            if error is not None:
+                logger.warn("Failed to scrape VPX " + vpx['instance-id'] + ": " + str(error))
+                continue
+            if len(samples) == 0:
+                continue
+            if SCRAPE_ROUNDS > 1:
+                rounds.setdefault(vpx['instance-id'], []).append(samples)
+                continue
+            publish_samples(sinks, vpx, [samples])
+
+    for stores in rounds.values():
+        publish_samples(sinks, stores[0].vpx, stores)
+
+    for sink in sinks:
+        if sink in SINK_FLUSHES:
+            try:
+                SINK_FLUSHES[sink]()
+            except Exception as e:
+                logger.warn("Failed to push to " + sink + ": " + str(e))
+
+    if 'cloudwatch' in sinks:
+        log_cloudwatch_put_stats()
+
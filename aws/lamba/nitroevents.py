@@ -0,0 +1,283 @@
+'''
+    Event loop based Nitro collection engine
+
+    Drives many Nitro HTTP(S) GET requests from a single thread using
+    non-blocking sockets and select(), with a global limit on the number
+    of requests in flight, a per-host limit and per-request/overall
+    deadlines. The AWS Lambda python2.7 runtime has no asyncio, so this
+    is the plain select() equivalent of an asyncio client.
+'''
+import errno
+import select
+import socket
+import ssl
+import time
+from collections import deque
+
+CONNECTING, HANDSHAKING, SENDING, RECEIVING = range(4)
+
+_ssl_context = None
+
+
+class NitroRequest(object):
+    '''
+        A single GET request to a Nitro endpoint
+        key is returned untouched along with the response
+    '''
+    def __init__(self, key, scheme, host, path, headers):
+        self.key = key
+        self.scheme = scheme
+        self.host = host
+        self.path = path
+        self.headers = headers
+
+
+class NitroResponse(object):
+    '''
+        Result of a NitroRequest
+        error is None on success, status/headers/body are set then
+    '''
+    def __init__(self, key, status=None, headers=None, body=None, error=None, latency=0.0):
+        self.key = key
+        self.status = status
+        self.headers = headers or {}
+        self.body = body
+        self.error = error
+        self.latency = latency
+
+
+class _Connection(object):
+    def __init__(self, request):
+        self.request = request
+        self.state = CONNECTING
+        self.started = time.time()
+        self.sock = None
+        self.out = ''
+        self.chunks = []
+        self.received = 0
+        self.header_end = -1
+        self.content_length = None
+        self.want_read = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def split_host_port(host, scheme):
+    '''
+        Method to split "ip[:port]" into (ip, port)
+    '''
+    if ':' in host:
+        ip, port = host.rsplit(':', 1)
+        return ip, int(port)
+    return host, 443 if scheme == 'https' else 80
+
+
+def build_request_bytes(request):
+    '''
+        Method to serialize the request as a HTTP/1.0 GET. The server
+        closes the connection after the response, so no chunked bodies
+        and no keep-alive bookkeeping are needed here
+    '''
+    lines = ['GET ' + request.path + ' HTTP/1.0', 'Host: ' + request.host, 'Connection: close']
+    for name, value in request.headers.items():
+        lines.append(name + ': ' + value)
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+def parse_response(data):
+    '''
+        Method to split a raw HTTP response into (status, headers, body)
+    '''
+    head, _, body = data.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    status = int(lines[0].split(' ', 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = decode_chunked(body)
+    return status, headers, body
+
+
+def decode_chunked(body):
+    '''
+        Method to decode a chunked transfer encoded body
+    '''
+    out = []
+    pos = 0
+    while True:
+        line_end = body.index('\r\n', pos)
+        size = int(body[pos:line_end].split(';')[0], 16)
+        if size == 0:
+            return ''.join(out)
+        out.append(body[line_end + 2:line_end + 2 + size])
+        pos = line_end + 2 + size + 2
+
+
+def fetch_all(requests, max_inflight=64, max_per_host=4, timeout=10.0, deadline=None):
+    '''
+        Method to run all the NitroRequest(s) from one event loop
+        Yields a NitroResponse for each request as soon as it completes
+        timeout bounds a single request, deadline (absolute time.time())
+        bounds the whole collection; requests not started or not done by
+        then are failed with a timeout error
+    '''
+    pending = deque(requests)
+    inflight = {}  # fd -> _Connection
+    per_host = {}
+
+    while pending or inflight:
+        now = time.time()
+
+        if deadline is not None and now >= deadline:
+            for conn in inflight.values():
+                conn.sock.close()
+                yield NitroResponse(conn.request.key, error='deadline exceeded', latency=now - conn.started)
+            for request in pending:
+                yield NitroResponse(request.key, error='deadline exceeded')
+            return
+
+        # Start as many queued requests as the global and per-host limits allow
+        skipped = deque()
+        while pending and len(inflight) < max_inflight:
+            request = pending.popleft()
+            if per_host.get(request.host, 0) >= max_per_host:
+                skipped.append(request)
+                continue
+            conn = _Connection(request)
+            try:
+                conn.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                conn.sock.setblocking(0)
+                err = conn.sock.connect_ex(split_host_port(request.host, request.scheme))
+                if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise socket.error(err, errno.errorcode.get(err, str(err)))
+            except (socket.error, ValueError) as e:
+                if conn.sock is not None:
+                    conn.sock.close()
+                yield NitroResponse(request.key, error=str(e))
+                continue
+            conn.out = build_request_bytes(request)
+            inflight[conn.fileno()] = conn
+            per_host[request.host] = per_host.get(request.host, 0) + 1
+        skipped.extend(pending)
+        pending = skipped
+
+        if not inflight:
+            continue
+
+        readers = [c for c in inflight.values() if c.state == RECEIVING or
+                   (c.state == HANDSHAKING and c.want_read)]
+        writers = [c for c in inflight.values() if c.state in (CONNECTING, SENDING) or
+                   (c.state == HANDSHAKING and not c.want_read)]
+        wait = min(timeout - (now - c.started) for c in inflight.values())
+        if deadline is not None:
+            wait = min(wait, deadline - now)
+        readable, writable, _ = select.select(readers, writers, [], max(wait, 0))
+
+        done = []
+        for conn in writable + readable:
+            if conn.fileno() in done:
+                continue
+            try:
+                if not _advance(conn):
+                    continue
+                response = NitroResponse(conn.request.key, *parse_response(''.join(conn.chunks)))
+            except (socket.error, ssl.SSLError, ValueError, IndexError) as e:
+                response = NitroResponse(conn.request.key, error=str(e))
+            response.latency = time.time() - conn.started
+            done.append(conn.fileno())
+            yield response
+
+        now = time.time()
+        for fd, conn in inflight.items():
+            if fd not in done and now - conn.started >= timeout:
+                done.append(fd)
+                yield NitroResponse(conn.request.key, error='timed out', latency=now - conn.started)
+
+        for fd in done:
+            conn = inflight.pop(fd)
+            conn.sock.close()
+            per_host[conn.request.host] -= 1
+
+
+def get_ssl_context():
+    '''
+        Method to get the SSL context shared by all the https requests
+    '''
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        _ssl_context.check_hostname = False
+        _ssl_context.verify_mode = ssl.CERT_NONE  # VPX(s) serve a self signed certificate
+    return _ssl_context
+
+
+def _advance(conn):
+    '''
+        Method to move a connection through its states as far as the
+        socket allows without blocking. Returns True once the full
+        response is received
+    '''
+    if conn.state == CONNECTING:
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise socket.error(err, errno.errorcode.get(err, str(err)))
+        if conn.request.scheme == 'https':
+            conn.sock = get_ssl_context().wrap_socket(conn.sock, do_handshake_on_connect=False)
+            conn.state = HANDSHAKING
+        else:
+            conn.state = SENDING
+
+    if conn.state == HANDSHAKING:
+        try:
+            conn.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            conn.want_read = True
+            return False
+        except ssl.SSLWantWriteError:
+            conn.want_read = False
+            return False
+        conn.state = SENDING
+
+    if conn.state == SENDING:
+        try:
+            sent = conn.sock.send(conn.out)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return False
+        conn.out = conn.out[sent:]
+        if conn.out:
+            return False
+        conn.state = RECEIVING
+        return False
+
+    if conn.state == RECEIVING:
+        while True:
+            try:
+                data = conn.sock.recv(65536)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return False
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            if not data:
+                if conn.header_end < 0:
+                    raise ValueError('connection closed before the response headers')
+                return True
+            conn.chunks.append(data)
+            conn.received += len(data)
+            if conn.header_end < 0:
+                raw = ''.join(conn.chunks)
+                conn.chunks = [raw]
+                conn.header_end = raw.find('\r\n\r\n')
+                if conn.header_end >= 0:
+                    for line in raw[:conn.header_end].split('\r\n')[1:]:
+                        name, _, value = line.partition(':')
+                        if name.strip().lower() == 'content-length':
+                            conn.content_length = int(value.strip())
+            if conn.content_length is not None and \
+                    conn.received >= conn.header_end + 4 + conn.content_length:
+                return True
+    return False
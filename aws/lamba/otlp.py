@@ -0,0 +1,82 @@
+'''
+    OpenTelemetry OTLP metrics encoding
+
+    Encodes the protobuf messages of an OTLP ExportMetricsServiceRequest
+    (opentelemetry/proto/metrics/v1/metrics.proto) by hand, as there is
+    no protobuf in the AWS Lambda python2.7 runtime. Only what the
+    Lambda exports is covered: string attributes, and gauges and sums
+    of int data points.
+
+        ExportMetricsServiceRequest { repeated ResourceMetrics resource_metrics = 1; }
+        ResourceMetrics { Resource resource = 1; repeated ScopeMetrics scope_metrics = 2; }
+        Resource        { repeated KeyValue attributes = 1; }
+        ScopeMetrics    { InstrumentationScope scope = 1; repeated Metric metrics = 2; }
+        Metric          { string name = 1; string description = 2; string unit = 3;
+                          Gauge gauge = 5; Sum sum = 7; }
+        Gauge           { repeated NumberDataPoint data_points = 1; }
+        Sum             { repeated NumberDataPoint data_points = 1;
+                          AggregationTemporality aggregation_temporality = 2; bool is_monotonic = 3; }
+        NumberDataPoint { fixed64 start_time_unix_nano = 2; fixed64 time_unix_nano = 3;
+                          sfixed64 as_int = 6; repeated KeyValue attributes = 7; }
+'''
+import struct
+
+from remotewrite import encode_varint
+
+GAUGE, SUM = 5, 7   # Metric fields of the data kinds
+AGGREGATION_TEMPORALITY_CUMULATIVE = 2
+
+
+def encode_field(number, payload):
+    '''
+        Method to encode a length delimited field (string or message)
+    '''
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    return encode_varint(number << 3 | 2) + encode_varint(len(payload)) + payload
+
+
+def encode_attribute(key, value, number):
+    '''
+        Method to encode a KeyValue with a string value as field number
+        of its parent message
+    '''
+    return encode_field(number, encode_field(1, key) + encode_field(2, encode_field(1, value)))
+
+
+def encode_number_point(attributes, time_unix_nano, value, start_time_unix_nano=0):
+    '''
+        Method to encode an int NumberDataPoint, framed as field 1 of a
+        Gauge or Sum; attributes are encode_attribute(s) for field 7
+        start_time_unix_nano is left out when 0, as it is for gauges
+    '''
+    point = '\x19' + struct.pack('<Q', time_unix_nano) + '\x31' + struct.pack('<q', value) + attributes
+    if start_time_unix_nano:
+        point = '\x11' + struct.pack('<Q', start_time_unix_nano) + point
+    return encode_field(1, point)
+
+
+def encode_metric(name, description, unit, kind, monotonic, points):
+    '''
+        Method to encode a Metric of the GAUGE or SUM kind, framed as
+        field 2 of a ScopeMetrics; points are encode_number_point(s)
+        Sums are cumulative
+    '''
+    data = ''.join(points)
+    if kind == SUM:
+        data += '\x10' + encode_varint(AGGREGATION_TEMPORALITY_CUMULATIVE) + '\x18' + ('\x01' if monotonic else '\x00')
+    metric = encode_field(1, name) + encode_field(2, description) + encode_field(3, unit) + encode_field(kind, data)
+    return encode_field(2, metric)
+
+
+def encode_resource_metrics(attributes, scope_name, scope_version, metrics):
+    '''
+        Method to encode a ResourceMetrics with a single scope, framed as
+        field 1 of an ExportMetricsServiceRequest; a request is the
+        concatenation of its resources
+        attributes are encode_attribute(s) for field 1, metrics
+        encode_metric(s)
+    '''
+    scope = encode_field(1, encode_field(1, scope_name) + encode_field(2, scope_version))
+    resource = encode_field(1, attributes) + encode_field(2, scope + ''.join(metrics))
+    return encode_field(1, resource)
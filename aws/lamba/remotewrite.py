@@ -0,0 +1,141 @@
+'''
+    Prometheus remote write encoding
+
+    Encodes the protobuf messages of a remote write request and
+    compresses it with snappy, the block format remote write expects.
+    Neither protobuf nor python-snappy is in the AWS Lambda python2.7
+    runtime, so the few messages needed are written out by hand and
+    snappy falls back to a pure python compressor when python-snappy
+    is not in the deployment package.
+
+        message WriteRequest { repeated TimeSeries timeseries = 1; }
+        message TimeSeries   { repeated Label labels = 1; repeated Sample samples = 2; }
+        message Label        { string name = 1; string value = 2; }
+        message Sample       { double value = 1; int64 timestamp = 2; }
+'''
+import struct
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+SNAPPY_BLOCK_SIZE = 65536  # Copy offsets stay within a block, 2 bytes each
+SNAPPY_MIN_MATCH = 4
+
+
+def encode_varint(value):
+    '''
+        Method to encode an unsigned int as a protobuf varint
+    '''
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def encode_label(name, value):
+    '''
+        Method to encode a Label message, already framed as field 1 of a
+        TimeSeries, so that it can be reused across series
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    label = '\x0a' + encode_varint(len(name)) + name + '\x12' + encode_varint(len(value)) + value
+    return '\x0a' + encode_varint(len(label)) + label
+
+
+def encode_timeseries(labels, value, timestamp):
+    '''
+        Method to encode a TimeSeries with a single sample, framed as
+        field 1 of a WriteRequest; a WriteRequest is the concatenation
+        of its series
+        labels are encode_label(s) sorted by label name, timestamp is in
+        milliseconds
+    '''
+    sample = '\x09' + struct.pack('<d', value) + '\x10' + encode_varint(timestamp)
+    series = labels + '\x12' + encode_varint(len(sample)) + sample
+    return '\x0a' + encode_varint(len(series)) + series
+
+
+def snappy_compress(data):
+    '''
+        Method to compress data in the snappy block format
+    '''
+    if snappy is not None:
+        return snappy.compress(data)
+    out = [encode_varint(len(data))]
+    for start in range(0, len(data), SNAPPY_BLOCK_SIZE):
+        compress_block(data[start:start + SNAPPY_BLOCK_SIZE], out)
+    return ''.join(out)
+
+
+def compress_block(block, out):
+    '''
+        Method to append the snappy elements of a block to out
+        Greedy matching on a table of the last position of every 4 bytes
+        sequence; like snappy, the scan speeds up over data that doesn't
+        match
+    '''
+    table = {}
+    literal = 0     # Start of the bytes not emitted yet
+    i = 0
+    misses = 32
+    end = len(block) - SNAPPY_MIN_MATCH
+    while i <= end:
+        key = block[i:i + SNAPPY_MIN_MATCH]
+        candidate = table.get(key)
+        table[key] = i
+        if candidate is None:
+            i += misses >> 5
+            misses += 1
+            continue
+        length = SNAPPY_MIN_MATCH
+        while i + length + 8 <= len(block) and \
+                block[candidate + length:candidate + length + 8] == block[i + length:i + length + 8]:
+            length += 8
+        while i + length < len(block) and block[candidate + length] == block[i + length]:
+            length += 1
+        if literal < i:
+            emit_literal(block[literal:i], out)
+        emit_copy(i - candidate, length, out)
+        i += length
+        literal = i
+        misses = 32
+    if literal < len(block):
+        emit_literal(block[literal:], out)
+
+
+def emit_literal(literal, out):
+    '''
+        Method to append a snappy literal element to out
+    '''
+    n = len(literal) - 1
+    if n < 60:
+        out.append(chr(n << 2))
+    elif n < 0x100:
+        out.append(chr(60 << 2) + chr(n))
+    elif n < 0x10000:
+        out.append(chr(61 << 2) + struct.pack('<H', n))
+    else:
+        out.append(chr(62 << 2) + struct.pack('<I', n)[:3])
+    out.append(literal)
+
+
+def emit_copy(offset, length, out):
+    '''
+        Method to append the snappy copy element(s) of a match to out
+        A copy with a 2 bytes offset covers at most 64 bytes
+    '''
+    while length >= 68:
+        out.append(chr((63 << 2) | 2) + struct.pack('<H', offset))
+        length -= 64
+    if length > 64:
+        out.append(chr((59 << 2) | 2) + struct.pack('<H', offset))
+        length -= 60
+    if length < 12 and offset < 2048:
+        out.append(chr(((offset >> 8) << 5) | ((length - 4) << 2) | 1) + chr(offset & 0xff))
+    else:
+        out.append(chr(((length - 1) << 2) | 2) + struct.pack('<H', offset))
@@ -0,0 +1,139 @@
+'''
+    Stand-in Prometheus remote write receiver to try the Lambda's
+    prometheus sink against: decodes every snappy compressed
+    WriteRequest it is sent and prints what it got
+
+    Run it, then point the Lambda (or a local run of it) at it with
+    PROMETHEUS_REMOTE_WRITE_URL=http://<host>:<port>/api/v1/write
+        python remote-write-receiver.py [port] [series to print per request]
+'''
+import BaseHTTPServer
+import struct
+import sys
+
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 9201
+SHOW = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+def read_varint(data, pos):
+    '''
+        Method to read a varint at pos, returns (value, next pos)
+    '''
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def snappy_decompress(data):
+    '''
+        Method to decompress a snappy block format buffer
+    '''
+    length, pos = read_varint(data, 0)
+    out = bytearray()
+    while pos < len(data):
+        tag = ord(data[pos])
+        pos += 1
+        if tag & 3 == 0:
+            n = tag >> 2
+            if n >= 60:
+                size = n - 59
+                n = struct.unpack('<I', data[pos:pos + size] + '\x00' * (4 - size))[0]
+                pos += size
+            out += data[pos:pos + n + 1]
+            pos += n + 1
+            continue
+        if tag & 3 == 1:
+            n = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | ord(data[pos])
+            pos += 1
+        elif tag & 3 == 2:
+            n = (tag >> 2) + 1
+            offset = struct.unpack('<H', data[pos:pos + 2])[0]
+            pos += 2
+        else:
+            n = (tag >> 2) + 1
+            offset = struct.unpack('<I', data[pos:pos + 4])[0]
+            pos += 4
+        for _ in range(n):  # Copies may overlap what they produce
+            out.append(out[-offset])
+    if len(out) != length:
+        raise ValueError('snappy length %d, expected %d' % (len(out), length))
+    return str(out)
+
+def read_fields(data):
+    '''
+        Method to split a protobuf message into (field number, value)
+        Length delimited values are returned as strings, fixed64 as
+        doubles
+    '''
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = read_varint(data, pos)
+        elif wire_type == 1:
+            value = struct.unpack('<d', data[pos:pos + 8])[0]
+            pos += 8
+        elif wire_type == 2:
+            size, pos = read_varint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        else:
+            raise ValueError('unexpected wire type %d' % wire_type)
+        yield field, value
+
+def decode_write_request(data):
+    '''
+        Method to decode a WriteRequest into [(labels, [(value, timestamp)])]
+    '''
+    result = []
+    for field, timeseries in read_fields(data):
+        if field != 1:
+            continue
+        labels, samples = [], []
+        for series_field, value in read_fields(timeseries):
+            if series_field == 1:
+                label = dict(read_fields(value))
+                labels.append((label.get(1, ''), label.get(2, '')))
+            elif series_field == 2:
+                sample = dict(read_fields(value))
+                samples.append((sample.get(1, 0.0), sample.get(2, 0)))
+        result.append((labels, samples))
+    return result
+
+class RemoteWriteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            raw = snappy_decompress(body)
+            series = decode_write_request(raw)
+        except (ValueError, IndexError, struct.error) as e:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(str(e))
+            print('%s: bad request, %s' % (self.path, e))
+            return
+        self.send_response(204)
+        self.end_headers()
+        samples = sum(len(each[1]) for each in series)
+        print('%s: %d series, %d samples, %d bytes (%d uncompressed)' %
+              (self.path, len(series), samples, len(body), len(raw)))
+        for labels, points in series[:SHOW]:
+            names = [name for name, _ in labels]
+            if names != sorted(names):
+                print('    labels not sorted: %s' % names)
+            print('    %s{%s} %s' % (dict(labels).get('__name__'),
+                                    ','.join('%s="%s"' % label for label in labels if label[0] != '__name__'),
+                                    ' '.join('%s@%d' % point for point in points)))
+        sys.stdout.flush()
+
+    def log_message(self, *args):
+        pass
+
+if __name__ == '__main__':
+    print('Listening for remote write requests on port %d' % PORT)
+    BaseHTTPServer.HTTPServer(('', PORT), RemoteWriteHandler).serve_forever()
@@ -0,0 +1,96 @@
+'''
+    Micro-benchmark of the Lambda's transform step: parses synthetic
+    Nitro Stats of one VPX into samples and encodes them as CloudWatch
+    and Datadog metrics, reporting the records/second and the memory
+    each sample takes in the SampleStore and once encoded for a sink
+
+    Run from this directory with the Lambda's dependencies installed:
+        python transform-benchmark.py [entities per feature] [rounds]
+'''
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'aws', 'lamba'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')  # boto3 clients are created at import
+
+import lambda_function
+import citrixadcmetrics
+
+ENTITIES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+VPX = {'instance-id': 'i-0123456789abcdef0', 'asg-name': 'citrixadc-asg',
+       'nsip': '10.0.0.10', 'nsip-public': ''}
+
+def make_stats(entities):
+    '''
+        Method to build Nitro Stats for every feature in the template
+        The entity list features get that many named entities
+    '''
+    stats = {}
+    for feature, counters in citrixadcmetrics.metrics.items():
+        if feature in lambda_function.NITRO_ENTITY_FEATURES:
+            value = []
+            for i in range(entities):
+                entity = dict((c['MetricName'], str(i)) for c in counters)
+                entity['name'] = feature + '-' + str(i)
+                value.append(entity)
+        else:
+            value = dict((c['MetricName'], '42') for c in counters)
+        stats[feature] = {'errorcode': 0, feature: value}
+    return stats
+
+def stream_stats(stats):
+    '''
+        Method to hand out the entity lists as generators, the way
+        they come out of the streaming Nitro decoder
+    '''
+    streamed = {}
+    for feature, feature_stats in stats.items():
+        if type(feature_stats[feature]) == list:
+            streamed[feature] = {feature: (entity for entity in feature_stats[feature])}
+        else:
+            streamed[feature] = feature_stats
+    return streamed
+
+def deep_sizeof(obj, seen):
+    '''
+        Method to add up the memory used by obj and everything it
+        references, counting objects shared with earlier calls only once
+    '''
+    if id(obj) in seen or obj is None or isinstance(obj, lambda_function.CounterPlan):
+        return 0  # The metric plan is shared by all the scrapes
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif isinstance(obj, lambda_function.SampleStore):
+        size += sum(deep_sizeof(getattr(obj, slot), seen) for slot in obj.__slots__ if slot != 'vpx')
+    return size
+
+stats = make_stats(ENTITIES)
+for sinks in (['cloudwatch'], ['emf'], ['datadog'], ['cloudwatch', 'datadog']):
+    records = 0
+    start = time.time()
+    for _ in range(ROUNDS):
+        samples = lambda_function.parse_stats(VPX, lambda_function.METRIC_PLAN, stream_stats(stats))
+        for sink in sinks:
+            encode, _ = lambda_function.SINKS[sink]
+            records += sum(1 for _ in encode(samples))
+    elapsed = time.time() - start
+    print('%-22s %9d records %8.3fs %10d records/s' % ('+'.join(sinks), records, elapsed, records / elapsed))
+
+# Memory held per sample between the transform and the sinks
+samples = lambda_function.parse_stats(VPX, lambda_function.METRIC_PLAN, stats)
+print('')
+print('%-22s %9d samples' % ('per sample footprint', len(samples)))
+print('%-22s %9.1f bytes' % ('SampleStore', float(deep_sizeof(samples, set())) / len(samples)))
+sample_tuples = list(samples)
+print('%-22s %9.1f bytes' % ('sample tuples', float(deep_sizeof(sample_tuples, set([id(VPX)]))) / len(samples)))
+for sink in ('cloudwatch', 'emf', 'datadog'):
+    encode, _ = lambda_function.SINKS[sink]
+    encoded = list(encode(samples))
+    print('%-22s %9.1f bytes' % (sink + ' metrics', float(deep_sizeof(encoded, set())) / len(samples)))